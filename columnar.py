@@ -0,0 +1,164 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    columnar (numpy array backed) message store for bulk room queries
+"""
+from datetime import datetime
+
+from constants import *
+
+try:
+    import numpy as np
+except ImportError:  # only columnar rooms need numpy
+    np = None
+
+LOGGER = logging.getLogger(__name__)
+
+COLUMNAR_ENABLED = False
+COLUMNAR_INITIAL_CAPACITY = 1024
+
+
+def _resized(column, head: int, end: int, capacity: int):
+    """ copy the live part of a column to the front of a new array of the given capacity
+    """
+    new_column = np.zeros(capacity, dtype=column.dtype)
+    new_column[:end - head] = column[head:end]
+    return new_column
+
+
+class ColumnarMessageStore():
+    """ Keeps sequence_num, sent_time, sender id and removed flag of a room's messages in numpy arrays, one row per
+        message in put order (oldest first), with the ChatMessage objects themselves in a row aligned list.
+        Filters by sender, time range, removed flag or blacklist are vectorized masks over the live rows.
+        Evicting the oldest message moves a head offset, the arrays are compacted when they fill up
+    """
+
+    def __init__(self, capacity: int = COLUMNAR_INITIAL_CAPACITY) -> None:
+        if np is None:
+            raise ImportError('numpy is required for columnar message storage')
+        self.__sequence_nums = np.empty(capacity, dtype=np.int64)
+        self.__sent_times = np.empty(capacity, dtype='datetime64[us]')
+        self.__sender_ids = np.empty(capacity, dtype=np.int32)
+        self.__removed = np.zeros(capacity, dtype=bool)
+        self.__bodies = [None] * capacity
+        self.__head = 0
+        self.__end = 0
+        self.__sender_ids_by_alias = dict()
+
+    def __len__(self):
+        return self.__end - self.__head
+
+    def sender_id(self, alias: str) -> int:
+        """id of an alias in the sender column, -1 if it never sent a message here
+        """
+        return self.__sender_ids_by_alias.get(alias, -1)
+
+    def __intern_sender(self, alias: str) -> int:
+        if (sender_id := self.__sender_ids_by_alias.get(alias)) is None:
+            sender_id = len(self.__sender_ids_by_alias)
+            self.__sender_ids_by_alias[alias] = sender_id
+        return sender_id
+
+    def __make_room(self) -> None:
+        """ compact the live rows to the front, doubling the capacity unless more than half of it was evicted rows
+        """
+        live = self.__end - self.__head
+        capacity = len(self.__bodies)
+        new_capacity = capacity if self.__head > capacity // 2 else capacity * 2
+        self.__sequence_nums = _resized(self.__sequence_nums, self.__head, self.__end, new_capacity)
+        self.__sent_times = _resized(self.__sent_times, self.__head, self.__end, new_capacity)
+        self.__sender_ids = _resized(self.__sender_ids, self.__head, self.__end, new_capacity)
+        self.__removed = _resized(self.__removed, self.__head, self.__end, new_capacity)
+        self.__bodies = self.__bodies[self.__head:self.__end] + [None] * (new_capacity - live)
+        self.__head = 0
+        self.__end = live
+
+    def append(self, message) -> None:
+        """add a message as the newest row
+        """
+        if self.__end == len(self.__bodies):
+            self.__make_room()
+        row = self.__end
+        sent_time = message.mess_props.sent_time
+        self.__sequence_nums[row] = message.sequence_num
+        self.__sent_times[row] = np.datetime64(sent_time, 'us') if isinstance(sent_time, datetime) else np.datetime64('NaT')
+        self.__sender_ids[row] = self.__intern_sender(message.mess_props.from_user)
+        self.__removed[row] = message.removed
+        self.__bodies[row] = message
+        self.__end += 1
+
+    def pop_oldest(self) -> None:
+        """drop the oldest row, used when the room evicts a message from its window
+        """
+        if self.__end > self.__head:
+            self.__bodies[self.__head] = None
+            self.__head += 1
+
+    def refresh_sequence_num(self, message) -> None:
+        """copy a sequence number assigned after the message was appended (persist numbers late messages)
+        """
+        for row in range(self.__end - 1, self.__head - 1, -1):
+            if self.__bodies[row] is message:
+                self.__sequence_nums[row] = message.sequence_num
+                return
+
+    def mask(self, sender: str = None, start_time: datetime = None, end_time: datetime = None,
+             include_removed: bool = True, exclude_senders=None):
+        """boolean mask over the live rows (oldest first) matching every given condition
+
+        Args:
+            sender (str): only messages from this alias
+            start_time (datetime): only messages sent at or after this time
+            end_time (datetime): only messages sent before this time
+            include_removed (bool): False to leave out messages flagged as removed
+            exclude_senders (iterable): aliases to leave out, e.g. a blacklist
+
+        Returns:
+            numpy.ndarray: boolean mask with one entry per live row
+        """
+        live = slice(self.__head, self.__end)
+        mask = np.ones(self.__end - self.__head, dtype=bool)
+        if sender is not None:
+            mask &= self.__sender_ids[live] == self.sender_id(sender)
+        if start_time is not None:
+            mask &= self.__sent_times[live] >= np.datetime64(start_time, 'us')
+        if end_time is not None:
+            mask &= self.__sent_times[live] < np.datetime64(end_time, 'us')
+        if not include_removed:
+            mask &= ~self.__removed[live]
+        if exclude_senders:
+            excluded_ids = [self.sender_id(alias) for alias in exclude_senders if self.sender_id(alias) >= 0]
+            if len(excluded_ids) > 0:
+                mask &= ~np.isin(self.__sender_ids[live], excluded_ids)
+        return mask
+
+    def rows(self, mask=None, first: int = 0, count: int = -1):
+        """live row numbers (0 is the oldest live row) selected by mask, optionally limited to count rows starting at first
+        """
+        selected = np.arange(self.__end - self.__head)
+        if count >= 0:
+            selected = selected[first:first + count]
+            if mask is not None:
+                selected = selected[mask[first:first + count]]
+        elif mask is not None:
+            selected = selected[mask]
+        return selected
+
+    def messages(self, rows) -> list:
+        """ChatMessage objects for live row numbers, in the order given
+        """
+        return [self.__bodies[self.__head + row] for row in rows]
+
+    def set_removed(self, rows, removed: bool = True) -> list:
+        """flag rows as removed in the bitmap and on the messages themselves
+
+        Returns:
+            list: the ChatMessage objects that were flagged
+        """
+        self.__removed[self.__head + np.asarray(rows, dtype=np.int64)] = removed
+        flagged = self.messages(rows)
+        for message in flagged:
+            message.removed = removed
+        return flagged
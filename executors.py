@@ -0,0 +1,120 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    bounded thread pools for running blocking mongo calls and password hashing from async endpoints
+"""
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import *
+
+LOGGER = logging.getLogger(__name__)
+
+IO_EXECUTOR_WORKERS = 32
+IO_EXECUTOR_MAX_PENDING = 1000
+HASH_EXECUTOR_WORKERS = 4
+HASH_EXECUTOR_MAX_PENDING = 64
+
+
+class BoundedExecutor():
+    """ ThreadPoolExecutor with a limit on how many calls can be queued or running at once.
+        Async callers await run(), which waits for a free slot before handing the call to the pool,
+        so a burst of requests queues on the event loop instead of growing the pool's queue without bound
+    """
+
+    def __init__(self, max_workers: int = IO_EXECUTOR_WORKERS, max_pending: int = IO_EXECUTOR_MAX_PENDING,
+                 name: str = 'io') -> None:
+        self.__max_workers = max_workers
+        self.__max_pending = max_pending
+        self.__name = name
+        self.__executor = None
+        self.__lock = threading.Lock()
+        self.__slots = weakref.WeakKeyDictionary()
+        self.__pending = 0
+        self.__waiting = 0
+
+    @property
+    def pending(self) -> int:
+        """calls handed to the pool that have not finished yet
+        """
+        return self.__pending
+
+    @property
+    def waiting(self) -> int:
+        """callers waiting for a free slot before their call can be handed to the pool
+        """
+        return self.__waiting
+
+    @property
+    def max_pending(self) -> int:
+        return self.__max_pending
+
+    def __get_executor(self) -> ThreadPoolExecutor:
+        if self.__executor is None:
+            with self.__lock:
+                if self.__executor is None:
+                    LOGGER.info(f'Starting {self.__name} executor with {self.__max_workers} workers')
+                    self.__executor = ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix=f'{self.__name}-executor')
+        return self.__executor
+
+    def __get_slots(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        """one semaphore per event loop, an asyncio.Semaphore can only be awaited from the loop it was first used on
+        """
+        if (slots := self.__slots.get(loop)) is None:
+            slots = self.__slots[loop] = asyncio.Semaphore(self.__max_pending)
+        return slots
+
+    def __call(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.__lock:
+                self.__pending -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """run a blocking function in the pool and wait for its result without blocking the event loop
+
+        Args:
+            func (callable): blocking function, e.g. ChatRoom.send_message
+            args, kwargs: passed to func
+
+        Returns:
+            whatever func returns, exceptions raised by func are raised here
+        """
+        loop = asyncio.get_running_loop()
+        slots = self.__get_slots(loop)
+        self.__waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.__waiting -= 1
+        try:
+            with self.__lock:
+                self.__pending += 1
+            try:
+                future = loop.run_in_executor(self.__get_executor(), functools.partial(self.__call, func, args, kwargs))
+            except BaseException:
+                with self.__lock:
+                    self.__pending -= 1
+                raise
+            return await future
+        finally:
+            slots.release()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """finish the calls already handed to the pool and stop its threads. Called on shutdown
+        """
+        with self.__lock:
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+            LOGGER.info(f'Stopped {self.__name} executor')
+
+
+IO_EXECUTOR = BoundedExecutor()
+HASH_EXECUTOR = BoundedExecutor(max_workers=HASH_EXECUTOR_WORKERS, max_pending=HASH_EXECUTOR_MAX_PENDING, name='hash')
@@ -0,0 +1,166 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    process wide MongoClient registry shared by the chat model classes
+"""
+import threading
+
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+
+from constants import *
+
+LOGGER = logging.getLogger(__name__)
+
+MONGO_AUTH_SOURCE = 'cpsc313'
+MONGO_AUTH_MECHANISM = 'SCRAM-SHA-256'
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+MONGO_MAX_IDLE_TIME_MS = 60000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = 10000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+
+
+class PoolStatsListener(ConnectionPoolListener):
+    """ keeps running counts of connection pool events for one MongoClient
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__stats = {
+            'pools_created': 0,
+            'pools_cleared': 0,
+            'connections_created': 0,
+            'connections_closed': 0,
+            'connections_open': 0,
+            'connections_checked_out': 0,
+            'check_out_failures': 0,
+        }
+
+    def __count(self, key: str, amount: int = 1) -> None:
+        with self.__lock:
+            self.__stats[key] += amount
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(self.__stats)
+
+    def pool_created(self, event):
+        self.__count('pools_created')
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.__count('pools_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.__count('connections_created')
+        self.__count('connections_open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.__count('connections_closed')
+        self.__count('connections_open', -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.__count('check_out_failures')
+
+    def connection_checked_out(self, event):
+        self.__count('connections_checked_out')
+
+    def connection_checked_in(self, event):
+        self.__count('connections_checked_out', -1)
+
+
+class MongoClientRegistry():
+    """ hands out one MongoClient per set of connection settings so every room and list in the
+        process shares the same connection pool, monitor threads and authentication
+    """
+
+    def __init__(self, max_pool_size: int = MONGO_MAX_POOL_SIZE, min_pool_size: int = MONGO_MIN_POOL_SIZE,
+                 max_idle_time_ms: int = MONGO_MAX_IDLE_TIME_MS, connect_timeout_ms: int = MONGO_CONNECT_TIMEOUT_MS,
+                 socket_timeout_ms: int = MONGO_SOCKET_TIMEOUT_MS, server_selection_timeout_ms: int = MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                 wait_queue_timeout_ms: int = MONGO_WAIT_QUEUE_TIMEOUT_MS) -> None:
+        self.__lock = threading.Lock()
+        self.__clients = dict()
+        self.__listeners = dict()
+        self.__pool_options = {
+            'maxPoolSize': max_pool_size,
+            'minPoolSize': min_pool_size,
+            'maxIdleTimeMS': max_idle_time_ms,
+            'connectTimeoutMS': connect_timeout_ms,
+            'socketTimeoutMS': socket_timeout_ms,
+            'serverSelectionTimeoutMS': server_selection_timeout_ms,
+            'waitQueueTimeoutMS': wait_queue_timeout_ms,
+        }
+
+    @property
+    def pool_options(self) -> dict:
+        return dict(self.__pool_options)
+
+    def configure(self, **pool_options) -> None:
+        """change the pool settings used for clients created after this call
+
+        Args:
+            pool_options: MongoClient pool keyword arguments (maxPoolSize, socketTimeoutMS, ...)
+        """
+        with self.__lock:
+            if len(self.__clients) > 0:
+                LOGGER.warning('Configuring mongo pool after clients were created, existing clients keep their settings')
+            self.__pool_options.update(pool_options)
+
+    def get_client(self, host: str = MONGO_HOST, port: int = MONGO_PORT, username: str = USERNAME, password: str = PASSWORD,
+                   auth_source: str = MONGO_AUTH_SOURCE) -> MongoClient:
+        """get the shared client for the given connection settings, creating it on first use
+
+        Returns:
+            MongoClient: client shared by the whole process
+        """
+        key = (host, port, username, auth_source)
+        if (client := self.__clients.get(key)) is not None:
+            return client
+        with self.__lock:
+            if (client := self.__clients.get(key)) is None:
+                LOGGER.info(f'Creating shared MongoClient for {host}:{port} with options {self.__pool_options}')
+                listener = PoolStatsListener()
+                client = MongoClient(host=host, port=port, username=username, password=password, authSource=auth_source,
+                                     authMechanism=MONGO_AUTH_MECHANISM, event_listeners=[listener], **self.__pool_options)
+                self.__listeners[key] = listener
+                self.__clients[key] = client
+        return client
+
+    def pool_stats(self) -> dict:
+        """connection pool counters for every client in the registry
+
+        Returns:
+            dict: '{host}:{port}' mapped to the counters of that client's pool
+        """
+        with self.__lock:
+            return {f'{host}:{port}': listener.stats for (host, port, username, auth_source), listener in self.__listeners.items()}
+
+    def close_all(self) -> None:
+        """close every shared client. Called when the app shuts down
+        """
+        with self.__lock:
+            for client in self.__clients.values():
+                client.close()
+            LOGGER.info(f'Closed {len(self.__clients)} shared MongoClient(s)')
+            self.__clients.clear()
+            self.__listeners.clear()
+
+
+MONGO_CLIENTS = MongoClientRegistry()
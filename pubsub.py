@@ -0,0 +1,179 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    in process publish/subscribe of new room messages for push streams
+"""
+import asyncio
+import threading
+
+from constants import *
+
+LOGGER = logging.getLogger(__name__)
+
+PUBSUB_QUEUE_SIZE = 256
+
+
+class Subscription():
+    """ One subscriber to a topic. Messages are buffered in a bounded asyncio queue on the subscriber's event loop.
+        When a slow consumer lets the buffer fill up the oldest message is dropped and counted, so the consumer can
+        catch up from its last sequence number instead of holding up the publisher
+    """
+
+    def __init__(self, topic: str, loop: asyncio.AbstractEventLoop, skip=None, max_queue: int = PUBSUB_QUEUE_SIZE) -> None:
+        self.__topic = topic
+        self.__loop = loop
+        self.__skip = skip
+        self.__queue = asyncio.Queue(maxsize=max_queue)
+        self.__dropped = 0
+
+    @property
+    def topic(self) -> str:
+        return self.__topic
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.__loop
+
+    @property
+    def dropped(self) -> int:
+        """messages thrown away since the last call to take_dropped
+        """
+        return self.__dropped
+
+    def take_dropped(self) -> int:
+        dropped, self.__dropped = self.__dropped, 0
+        return dropped
+
+    def deliver(self, message) -> None:
+        """buffer a message, runs on the subscriber's event loop
+        """
+        if self.__skip is not None and self.__skip(message):
+            return
+        if self.__queue.full():
+            self.__queue.get_nowait()
+            self.__dropped += 1
+        self.__queue.put_nowait(message)
+
+    async def get(self, timeout: float = None):
+        """wait for the next message
+
+        Args:
+            timeout (float): seconds to wait, None to wait forever
+
+        Returns:
+            the next message, or None if the timeout expired first
+        """
+        try:
+            return await asyncio.wait_for(self.__queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class MessageBroker():
+    """ Topic based broker. Publishers call publish from any thread; each message is handed to every event loop with
+        subscribers on the topic with a single call_soon_threadsafe, and fanned out to that loop's subscribers there.
+        An idle subscriber is just a task waiting on its queue, so it costs no CPU until something is published.
+        Long polling requests don't need a queue of their own, they park on one asyncio.Condition per topic and loop
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__topics = dict()
+        self.__conditions = dict()
+
+    def subscribe(self, topic: str, skip=None, max_queue: int = PUBSUB_QUEUE_SIZE) -> Subscription:
+        """subscribe the running event loop to a topic. Must be called from a coroutine
+
+        Args:
+            topic (str): topic name, e.g. a room name
+            skip (callable): skip(message) returning True leaves the message out of this subscription, e.g. a blacklist check
+            max_queue (int): messages buffered before the oldest is dropped
+
+        Returns:
+            Subscription: await its get() for messages, pass it to unsubscribe when done
+        """
+        subscription = Subscription(topic, asyncio.get_running_loop(), skip, max_queue)
+        with self.__lock:
+            self.__topics.setdefault(topic, dict())[id(subscription)] = subscription
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.__lock:
+            if (subscriptions := self.__topics.get(subscription.topic)) is not None:
+                subscriptions.pop(id(subscription), None)
+                if len(subscriptions) == 0:
+                    del self.__topics[subscription.topic]
+
+    def subscriber_count(self, topic: str) -> int:
+        with self.__lock:
+            return len(self.__topics.get(topic, ()))
+
+    async def wait(self, topic: str, timeout: float, predicate) -> bool:
+        """park until predicate() is true, checking it again each time something is published to the topic
+
+        Args:
+            topic (str): topic name, e.g. a room name
+            timeout (float): seconds to wait at most
+            predicate (callable): condition to wait for, e.g. the room has a message newer than the caller's
+
+        Returns:
+            bool: the predicate result, False if the timeout expired first
+        """
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            waiters = self.__conditions.setdefault(topic, dict()).setdefault(loop, [asyncio.Condition(), 0])
+            waiters[1] += 1
+        condition = waiters[0]
+        try:
+            async with condition:
+                return await asyncio.wait_for(condition.wait_for(predicate), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.__lock:
+                waiters[1] -= 1
+                if waiters[1] == 0 and (topic_conditions := self.__conditions.get(topic)) is not None:
+                    topic_conditions.pop(loop, None)
+                    if len(topic_conditions) == 0:
+                        del self.__conditions[topic]
+
+    @staticmethod
+    async def __notify_all(condition: asyncio.Condition) -> None:
+        async with condition:
+            condition.notify_all()
+
+    def publish(self, topic: str, message) -> None:
+        """hand a message to every subscriber of the topic and wake the requests waiting on it, safe to call from any thread
+        """
+        if topic in self.__conditions:
+            with self.__lock:
+                conditions = [(loop, waiters[0]) for loop, waiters in self.__conditions.get(topic, dict()).items()]
+            for loop, condition in conditions:
+                try:
+                    asyncio.run_coroutine_threadsafe(self.__notify_all(condition), loop)
+                except RuntimeError:
+                    LOGGER.debug(f'Event loop waiting on {topic} is closed')
+        if topic not in self.__topics:
+            return
+        with self.__lock:
+            subscriptions = list(self.__topics.get(topic, dict()).values())
+        by_loop = dict()
+        for subscription in subscriptions:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        for loop, loop_subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(self.__deliver, loop_subscriptions, message)
+            except RuntimeError:
+                LOGGER.debug(f'Event loop for {len(loop_subscriptions)} subscriptions to {topic} is closed, unsubscribing them')
+                for subscription in loop_subscriptions:
+                    self.unsubscribe(subscription)
+
+    @staticmethod
+    def __deliver(subscriptions: list, message) -> None:
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+
+MESSAGE_BROKER = MessageBroker()
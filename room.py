@@ -5,29 +5,72 @@
 
     Room Chat implementation
 """
+import bisect
+import json
+import re
+import sys
+import threading
 from collections import deque
-from datetime import datetime
+from itertools import islice
+from datetime import datetime, timedelta
 
-from pymongo import MongoClient, ReturnDocument
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+from columnar import COLUMNAR_ENABLED, ColumnarMessageStore
 from constants import *
+from mongo_pool import MONGO_CLIENTS
+from pubsub import MESSAGE_BROKER
+from search_index import SEARCH_DEFAULT_LIMIT, MessageSearchIndex, matches, parse_query, tokenize
+from sequence import SequenceLease
 from users import *
+from write_behind import WRITE_BEHIND, WRITE_BEHIND_ENABLED
 from statsd import StatsClient
 
+try:
+    import orjson
+except ImportError:  # the standard json module is used without it
+    orjson = None
+
 STATSCLIENT = StatsClient(STATS_CLIENT_IP)
 
 LOGGER = logging.getLogger(__name__)
 
+HOT_WINDOW_MESSAGES = 1000
+HOT_WINDOW_SECONDS = None
+FILTERED_VIEW_CACHE_SIZE = 64
+DUPLICATE_KEY_ERROR = 11000
+ROOM_EVENT_MEMBER_ADDED = 'member_added'
+ROOM_EVENT_MEMBER_REMOVED = 'member_removed'
+
+
+def encode_json(value) -> bytes:
+    """ JSON encode a value to bytes, with orjson when it is installed. Datetimes become ISO 8601 strings
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=lambda other: other.isoformat() if isinstance(other, datetime) else str(other),
+                      separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _intern(value):
+    """ intern room names and aliases so every message in a room shares one copy of each string
+    """
+    return sys.intern(value) if type(value) is str else value
+
 
 class MessageProperties:
     """class holding the properties of ChatMessages
+        __slots__ keeps a message's properties free of a per instance __dict__
     """
+    __slots__ = ('__room_name', '__mess_type', '__to_user', '__from_user', '__sent_time', '__rec_time')
 
     def __init__(self, room_name: str, mess_type: int, to_user: str, from_user: str, sent_time: datetime, rec_time: datetime) -> None:
-        self.__room_name = room_name
+        self.__room_name = _intern(room_name)
         self.__mess_type = mess_type
-        self.__to_user = to_user
-        self.__from_user = from_user
+        self.__to_user = _intern(to_user)
+        self.__from_user = _intern(from_user)
         self.__sent_time = sent_time
         self.__rec_time = rec_time
 
@@ -72,6 +115,7 @@ class MessageProperties:
 class ChatMessage:
     """ class for storing messages in the ChatRoom
     """
+    __slots__ = ('__message', '__mess_id', '__mess_props', '__sequence_num', '__dirty', '__removed', '__json', '__full_json')
 
     def __init__(self, message: str, mess_id: int, mess_props: MessageProperties, sequence_num: int = -1):
         self.__message = message
@@ -80,6 +124,8 @@ class ChatMessage:
         self.__sequence_num = sequence_num
         self.__dirty = True
         self.__removed = False
+        self.__json = None
+        self.__full_json = None
 
     @property
     def message(self):
@@ -105,6 +151,7 @@ class ChatMessage:
     def sequence_num(self, new_value):
         if isinstance(new_value, int):
             self.__sequence_num = new_value
+            self.__full_json = None
 
     @property
     def removed(self):
@@ -117,7 +164,7 @@ class ChatMessage:
 
     @mess_id.setter
     def mess_id(self, new_value):
-        if isinstance(new_value, int):
+        if new_value is not None:
             self.__mess_id = new_value
 
     @dirty.setter
@@ -125,37 +172,169 @@ class ChatMessage:
         if isinstance(new_value, bool):
             self.__dirty = new_value
 
+    @property
+    def json_bytes(self) -> bytes:
+        """the message text as encoded JSON, built once and cached
+        """
+        if self.__json is None:
+            self.__json = encode_json(self.__message)
+        return self.__json
+
+    @property
+    def full_json_bytes(self) -> bytes:
+        """the message as an encoded JSON object with sequence_num, from_user, sent_time and message, built once and cached
+        """
+        if self.__full_json is None:
+            self.__full_json = encode_json({"sequence_num": self.__sequence_num, "from_user": self.__mess_props.from_user,
+                                            "sent_time": self.__mess_props.sent_time, "message": self.__message})
+        return self.__full_json
+
+    def encode(self) -> None:
+        """build the cached JSON now, so responses only have to join bytes
+        """
+        self.json_bytes
+        self.full_json_bytes
+
     def to_dict(self):
         """Controlling getting data from the class in a dictionary. Yes, I know there is a built in __dict__ but I wanted to retain control"""
         mess_props_dict = self.mess_props.to_dict()
-        return {"message": self.message, "sequence_num": self.sequence_num, "removed": self.removed, "mess_props": mess_props_dict}
+        return {"message": self.message, "sequence_num": self.sequence_num, "removed": self.removed, "mess_props": mess_props_dict,
+                "tokens": sorted(set(tokenize(self.message)))}
 
     def __str__(self):
         return f"Chat Message: {self.message} - message props: {self.mess_props}"
 
 
+class SequenceIndex():
+    """ index of the messages in a room's window by sequence_num. A dict gives O(1) lookups and a sorted list of the
+        sequence numbers gives O(log n) range slicing. Evictions from the old end just move a head offset; the list is
+        compacted once more than half of it is dead
+    """
+
+    COMPACT_MIN = 1024
+
+    def __init__(self) -> None:
+        self.__by_seq = dict()
+        self.__keys = []
+        self.__head = 0
+
+    def __len__(self):
+        return len(self.__by_seq)
+
+    @property
+    def first(self) -> int:
+        """lowest indexed sequence number, -1 if empty
+        """
+        return self.__keys[self.__head] if self.__head < len(self.__keys) else -1
+
+    @property
+    def last(self) -> int:
+        """highest indexed sequence number, -1 if empty
+        """
+        return self.__keys[-1] if self.__head < len(self.__keys) else -1
+
+    def add(self, message: ChatMessage) -> None:
+        sequence_num = message.sequence_num
+        if sequence_num < 0:
+            return
+        if sequence_num not in self.__by_seq:
+            if self.__head == len(self.__keys) or sequence_num > self.__keys[-1]:
+                self.__keys.append(sequence_num)
+            else:
+                bisect.insort(self.__keys, sequence_num, lo=self.__head)
+        self.__by_seq[sequence_num] = message
+
+    def discard(self, message: ChatMessage) -> None:
+        sequence_num = message.sequence_num
+        if self.__by_seq.get(sequence_num) is not message:
+            return
+        del self.__by_seq[sequence_num]
+        if self.__keys[self.__head] == sequence_num:
+            self.__head += 1
+            if self.__head >= self.COMPACT_MIN and self.__head * 2 > len(self.__keys):
+                del self.__keys[:self.__head]
+                self.__head = 0
+        else:
+            del self.__keys[bisect.bisect_left(self.__keys, sequence_num, lo=self.__head)]
+
+    def get(self, sequence_num: int) -> ChatMessage:
+        return self.__by_seq.get(sequence_num)
+
+    def range(self, start_seq: int, end_seq: int) -> list:
+        """messages with start_seq <= sequence_num <= end_seq, oldest first
+        """
+        low = bisect.bisect_left(self.__keys, start_seq, lo=self.__head)
+        high = bisect.bisect_right(self.__keys, end_seq, lo=low)
+        return [self.__by_seq[sequence_num] for sequence_num in self.__keys[low:high]]
+
+    def after(self, sequence_num: int, limit: int = -1) -> list:
+        """messages with a sequence number above sequence_num, oldest first, at most limit of them if limit > 0
+        """
+        low = bisect.bisect_right(self.__keys, sequence_num, lo=self.__head)
+        high = len(self.__keys) if limit <= 0 else min(len(self.__keys), low + limit)
+        return [self.__by_seq[key] for key in self.__keys[low:high]]
+
+
 class ChatRoom(deque):
     """A chat room class to hold messages from mongodb
     """
 
-    def __init__(self, room_name: str, member_list: list, owner_alias: str, room_type: int, create_new: bool):
-        super(ChatRoom, self).__init__()
+    def __init__(self, room_name: str, member_list: list, owner_alias: str, room_type: int, create_new: bool, user_list: UserList = None,
+                 write_behind: bool = WRITE_BEHIND_ENABLED, lazy: bool = False, hot_window: int = HOT_WINDOW_MESSAGES,
+                 hot_window_seconds: float = HOT_WINDOW_SECONDS, columnar: bool = COLUMNAR_ENABLED):
+        """ create_new starts an empty room. Otherwise the room is restored from mongo, right away or, with lazy,
+            the first time its messages are touched (see ensure_loaded). A lazy room uses the given metadata until then
+            Only the newest hot_window messages (and, if hot_window_seconds is set, only those sent within that many seconds)
+            are kept in memory, older history is paged from mongo by get_messages
+            columnar also keeps the window in a ColumnarMessageStore (needs numpy) so bulk filters run as array masks
+        """
+        super(ChatRoom, self).__init__(maxlen=hot_window)
         self.__room_name = room_name
-        self.__user_list = UserList()
+        self.__hot_window_seconds = hot_window_seconds
+        self.__has_cold_history = False
+        self.__token_index_ready = False
+        self.__sequence_index = SequenceIndex()
+        self.__columns = ColumnarMessageStore() if columnar else None
+        self.__search_index = MessageSearchIndex()
+        self.__messages_by_sender = dict()
+        self.__version = 0
+        self.__filtered_views = dict()
+        self.__window_hits = 0
+        self.__window_misses = 0
+        self.__flusher = WRITE_BEHIND if write_behind else None
+        self.__user_list = user_list if user_list is not None else shared_user_list()
+        self.__user_list.subscribe(self.__on_user_changed)
         self.__member_list = []
+        self.__member_set = set()
+        self.__observers = []
         self.__owner_alias = owner_alias
         self.__room_type = room_type
         self.__removed = False
 
-        self.__mongo_client = MongoClient(host=MONGO_HOST, port=MONGO_PORT, username=USERNAME, password=PASSWORD, authSource='cpsc313', authMechanism='SCRAM-SHA-256')
+        self.__mongo_client = MONGO_CLIENTS.get_client()
         self.__mongo_db = self.__mongo_client.cpsc313
         self.__mongo_collection = self.__mongo_db.get_collection(room_name)
         self.__mongo_seq_collection = self.__mongo_db.get_collection('sequence')
+        self.__sequence = SequenceLease(self.__mongo_seq_collection, room_name)
+        # guards the window and its indexes. Writers and readers both take it, since API requests run on several threads
+        self.__lock = threading.RLock()
+        self.__dirty_messages = []
+        self.__load_lock = threading.Lock()
+        self.__loaded = True
         if self.__mongo_collection is None:
             self.__mongo_collection = self.__mongo_db.create_collection(room_name)
         if owner_alias not in member_list:
             member_list.append(owner_alias)
-        if create_new is True or self.__restore() is False:
+        if create_new is False and lazy is True:
+            self.__create_time = datetime.now()
+            self.__modify_time = self.__create_time
+            self.__dirty = False
+            self.__room_id = None
+            self.__member_list = list(member_list)
+            self.__member_set = set(member_list)
+            self.__deleted = False
+            self.__loaded = False
+        elif create_new is True or self.__restore() is False:
             self.__room_type = room_type
             self.__create_time = datetime.now()
             self.__modify_time = datetime.now()
@@ -163,6 +342,7 @@ class ChatRoom(deque):
             self.__dirty = True
             self.__room_id = None
             self.__member_list = member_list
+            self.__member_set = set(member_list)
             self.__deleted = False
             for member in member_list:
                 if self.__user_list.get(member) is not None:
@@ -194,40 +374,85 @@ class ChatRoom(deque):
     def removed(self):
         return self.__removed
 
+    @property
+    def write_behind(self):
+        return self.__flusher is not None
+
+    @property
+    def loaded(self):
+        return self.__loaded
+
+    @property
+    def last_sequence_num(self) -> int:
+        """sequence number of the newest message in the room, -1 if there are none
+        """
+        self.ensure_loaded()
+        return self.__sequence_index.last
+
+    @property
+    def version(self) -> int:
+        """counter that changes whenever a message is put or changed in the window
+        """
+        return self.__version
+
+    @property
+    def state(self) -> tuple:
+        """(last_sequence_num, version) read together under the room lock, so the two always describe the same window
+        """
+        self.ensure_loaded()
+        with self.__lock:
+            return self.__sequence_index.last, self.__version
+
+    @property
+    def window_stats(self) -> dict:
+        """hit and miss counts of get_messages against the in memory window
+        """
+        reads = self.__window_hits + self.__window_misses
+        return {
+            'window_size': len(self),
+            'window_limit': self.maxlen,
+            'hits': self.__window_hits,
+            'misses': self.__window_misses,
+            'hit_rate': self.__window_hits / reads if reads > 0 else 1.0,
+        }
+
     @removed.setter
     def removed(self, new_value):
         if isinstance(new_value, bool):
             self.__removed = new_value
 
-    def __get_next_sequence_num(self):
-        """ This is the method that you need for managing the sequence. Note that there is a separate collection for just this one document
-            gets the sequence collection
+    def is_member(self, member_name: str) -> bool:
+        """membership check against the member set, the member list only keeps the order for persisting
+            A lazy room is loaded first, the member list it got from the room list metadata can be behind its own document
         """
-        sequence_num = self.__mongo_seq_collection.find_one_and_update(
-            {'_id': 'userid'},
-            {'$inc': {self.room_name: 1}},
-            projection={self.room_name: True, '_id': False},
-            upsert=True,
-            return_document=ReturnDocument.AFTER)
-        return sequence_num
-
-    def __get_current_sequence_num(self):
-        if (sequence_num := self.__mongo_seq_collection.find_one({self.room_name: {'$exists': 'true'}})) is None:
-            return -1
-        return sequence_num[self.room_name]
+        self.ensure_loaded()
+        return member_name in self.__member_set
 
     def find_member(self, member_name) -> str:
-        for member in self.__member_list:
-            if member == member_name:
-                return member
-        return None
+        self.ensure_loaded()
+        return member_name if member_name in self.__member_set else None
+
+    def add_observer(self, callback) -> None:
+        """register a callback that is called as callback(event, room, member) when a member joins or leaves
+        """
+        if callback not in self.__observers:
+            self.__observers.append(callback)
+
+    def remove_observer(self, callback) -> None:
+        if callback in self.__observers:
+            self.__observers.remove(callback)
+
+    def notify(self, event: str, member_name: str) -> None:
+        for callback in list(self.__observers):
+            callback(event, self, member_name)
 
     def add_member(self, member_name: str):
-        """add new user to member list
+        """add new user to member list. A lazy room is loaded first, so restoring it later can't undo the change
 
         Args:
             member_name (str): user
         """
+        self.ensure_loaded()
         if self.__user_list.get(member_name) is None:
             LOGGER.warning('member not found in user list')
             return 10
@@ -235,34 +460,93 @@ class ChatRoom(deque):
             LOGGER.debug('member already exists')
             return 1
         self.__member_list.append(member_name)
+        self.__member_set.add(member_name)
+        self.__modify_time = datetime.now()
+        self.__dirty = True
+        self.notify(ROOM_EVENT_MEMBER_ADDED, member_name)
 
     def remove_group_member(self, member_name: str):
-        """remove user from member list
+        """remove user from member list. A lazy room is loaded first, so restoring it later can't undo the change
 
         Args:
             member_name (str): user name
         """
+        self.ensure_loaded()
+        if member_name not in self.__member_set:
+            LOGGER.debug(f'{member_name} is not a member of {self.__room_name}')
+            return
         self.__member_list.remove(member_name)
+        self.__member_set.discard(member_name)
+        self.__modify_time = datetime.now()
+        self.__dirty = True
+        self.notify(ROOM_EVENT_MEMBER_REMOVED, member_name)
+
+    def __on_user_changed(self, event: str, user: ChatUser):
+        """ called by the shared user list when a user changes. Deregistered users leave the room
+            Only rooms outside a RoomList are subscribed, see detach_user_list
+        """
+        if event != USER_EVENT_DEREGISTER:
+            return
+        self.ensure_loaded()
+        if self.find_member(user.alias) is not None:
+            LOGGER.debug(f'{user.alias} was deregistered, removing from room {self.__room_name}')
+            self.remove_group_member(user.alias)
+
+    def detach_user_list(self) -> None:
+        """ stop following the user list directly. A RoomList does this for the rooms it tracks and passes
+            deregistrations on through its member index, so a deregister only reaches the rooms the user is in
+        """
+        self.__user_list.unsubscribe(self.__on_user_changed)
 
     def __retrieve_messages(self):
         pass
 
-    def find_by_sequence_num(self, sequence_num) -> ChatMessage:
-        """ binary search implementation since the deque is sorted
-        """
-        num_messages = self.length()
-        cur_low_index = 0
-        cur_hi_index = num_messages - 1
-        while self[cur_low_index] < sequence_num < self[cur_hi_index]:
-            cur_mid = (cur_hi_index - cur_low_index) // 2
-            if sequence_num < self[cur_mid].sequence_num:
-                cur_hi_index = cur_mid
-            elif sequence_num > self[cur_mid].sequence_num:
-                cur_low_index = cur_mid
-            else:  # we found it!! we can return it
-                return self[cur_mid]
+    def ensure_loaded(self) -> None:
+        """ restore a lazily created room from mongo the first time it is used.
+            The lock makes concurrent first requests wait for one load instead of each loading the room
+        """
+        if self.__loaded:
+            return
+        with self.__load_lock:
+            if self.__loaded:
+                return
+            if self.__restore() is False:
+                LOGGER.warning(f'No document for lazy room {self.__room_name}, keeping the room list metadata')
+            self.__loaded = True
+
+    def find_by_sequence_num(self, sequence_num: int) -> ChatMessage:
+        """ find a message by sequence number through the sequence index, reading it from mongo if it is older than the window
+
+        Args:
+            sequence_num (int): sequence number to look for
+
+        Returns:
+            ChatMessage: found message or None
+        """
+        self.ensure_loaded()
+        with self.__lock:
+            if (message := self.__sequence_index.get(sequence_num)) is not None:
+                return message
+            first_hot_seq = self.__sequence_index.first
+        if self.__has_cold_history and (first_hot_seq < 0 or sequence_num < first_hot_seq):
+            if (mess_dict := self.__mongo_collection.find_one({"room_name": {"$exists": False}, "sequence_num": sequence_num})) is not None:
+                return self.__message_from_dict(mess_dict)
         return None
 
+    def find_by_sequence_range(self, start_seq: int, end_seq: int) -> list:
+        """ messages in the window with start_seq <= sequence_num <= end_seq, oldest first
+
+        Args:
+            start_seq (int): first sequence number
+            end_seq (int): last sequence number
+
+        Returns:
+            list: ChatMessage objects
+        """
+        self.ensure_loaded()
+        with self.__lock:
+            return self.__sequence_index.range(start_seq, end_seq)
+
     def __restore(self) -> bool:
         """We're restoring data from Mongo.
         First get the metadata record, but looking for a name key with find_one. If it exists, then we have the doc. If not, bail
@@ -283,98 +567,353 @@ class ChatRoom(deque):
         self.__owner_alias = room_metadata["owner_alias"]
         self.__room_type = room_metadata["room_type"]
         self.__member_list = room_metadata["member_list"]
+        previous_members, self.__member_set = self.__member_set, set(self.__member_list)
+        for member_name in self.__member_set - previous_members:
+            self.notify(ROOM_EVENT_MEMBER_ADDED, member_name)
+        for member_name in previous_members - self.__member_set:
+            self.notify(ROOM_EVENT_MEMBER_REMOVED, member_name)
         self.__room_id = room_metadata['_id']
         self.__deleted = room_metadata['deleted']
         self.__dirty = False
 
-        for mess_dict in self.__mongo_collection.find({"room_name": {"$exists": False}}).sort("sequence_num", 1):
-            new_mess_props = MessageProperties(
-                mess_dict["mess_props"]["room_name"],
-                mess_dict["mess_props"]["mess_type"],
-                mess_dict["mess_props"]["to_user"],
-                mess_dict["mess_props"]["from_user"],
-                mess_dict["mess_props"]["sent_time"],
-                mess_dict["mess_props"]["rec_time"],
-            )
-            new_message = ChatMessage(mess_dict["message"], mess_dict["_id"], new_mess_props, mess_dict["sequence_num"])
-            new_message.dirty = False
-            self.put(new_message)
+        query = {"room_name": {"$exists": False}}
+        if self.__hot_window_seconds is not None:
+            query["mess_props.sent_time"] = {"$gte": datetime.now() - timedelta(seconds=self.__hot_window_seconds)}
+        cursor = self.__mongo_collection.find(query).sort("sequence_num", -1)
+        if self.maxlen is not None:
+            cursor = cursor.limit(self.maxlen)
+        newest_first = [self.__message_from_dict(mess_dict) for mess_dict in cursor]
+        if (self.maxlen is not None and len(newest_first) == self.maxlen) or self.__hot_window_seconds is not None:
+            self.__has_cold_history = True
+        for new_message in reversed(newest_first):
+            self.put(new_message, notify=False)
         return True
 
+    def __message_from_dict(self, mess_dict: dict) -> ChatMessage:
+        """ build a ChatMessage from its mongo document
+        """
+        new_mess_props = MessageProperties(
+            mess_dict["mess_props"]["room_name"],
+            mess_dict["mess_props"]["mess_type"],
+            mess_dict["mess_props"]["to_user"],
+            mess_dict["mess_props"]["from_user"],
+            mess_dict["mess_props"]["sent_time"],
+            mess_dict["mess_props"]["rec_time"],
+        )
+        new_message = ChatMessage(mess_dict["message"], mess_dict["_id"], new_mess_props, mess_dict["sequence_num"])
+        new_message.removed = mess_dict.get("removed", False)
+        new_message.dirty = False
+        return new_message
+
+    def __get_cold_messages(self, num_messages: int, before_seq: int = -1) -> list:
+        """ page messages older than the in memory window from mongo
+
+        Args:
+            num_messages (int): how many older messages to read, 0 for all of them
+            before_seq (int): sequence number of the oldest message in the window, -1 if the window is empty
+
+        Returns:
+            list: ChatMessage objects, newest first
+        """
+        query = {"room_name": {"$exists": False}}
+        if before_seq >= 0:
+            query["sequence_num"] = {"$lt": before_seq}
+        cursor = self.__mongo_collection.find(query).sort("sequence_num", -1).limit(num_messages)
+        return [self.__message_from_dict(mess_dict) for mess_dict in cursor]
+
+    def __evict(self) -> None:
+        """ drop the oldest messages that fall out of the window. They stay in mongo and are paged in on demand
+            Only called from put, with the room lock held
+        """
+        while self.maxlen is not None and len(self) >= self.maxlen:
+            self.__pop_oldest()
+        if self.__hot_window_seconds is not None:
+            cutoff = datetime.now() - timedelta(seconds=self.__hot_window_seconds)
+            while len(self) > 0 and self[0].mess_props.sent_time is not None and self[0].mess_props.sent_time < cutoff:
+                self.__pop_oldest()
+
+    def __on_numbered(self, message: ChatMessage) -> None:
+        """ a message in the window got its sequence number after it was put
+        """
+        with self.__lock:
+            self.__sequence_index.add(message)
+            self.__search_index.add(message)
+            if self.__columns is not None:
+                self.__columns.refresh_sequence_num(message)
+
+    def __pop_oldest(self) -> None:
+        oldest = super().popleft()
+        self.__sequence_index.discard(oldest)
+        self.__search_index.discard(oldest)
+        if (sender_messages := self.__messages_by_sender.get(oldest.mess_props.from_user)) is not None:
+            if len(sender_messages) > 0 and sender_messages[0] is oldest:
+                sender_messages.popleft()
+            elif oldest in sender_messages:
+                sender_messages.remove(oldest)
+            if len(sender_messages) == 0:
+                del self.__messages_by_sender[oldest.mess_props.from_user]
+        if self.__columns is not None:
+            self.__columns.pop_oldest()
+        self.__has_cold_history = True
+
+    def __metadata(self) -> dict:
+        return {
+            "room_name": self.__room_name,
+            "owner_alias": self.__owner_alias,
+            "room_type": self.__room_type,
+            "member_list": self.__member_list,
+            'deleted': self.__deleted,
+            "create_time": self.__create_time,
+            "modify_time": self.__modify_time,
+        }
+
+    def mark_dirty(self, message: ChatMessage):
+        """ flag a message in this room as changed so the next persist writes it
+
+        Args:
+            message (ChatMessage): changed message
+        """
+        message.dirty = True
+        with self.__lock:
+            self.__version += 1
+            self.__dirty_messages.append(message)
+
     def persist(self):
-        """First save a document that describes the room list (metadata: name of list, create and modify times) if it isn't already there
-        Second, for each message in the list create and save a document for that message
+        """First save the document that describes the room (metadata: name, owner, members, create and modify times) if it changed
+        Second, write the messages that were added or changed since the last persist, new ones with a single insert_many
             NOTE: We're using our custom to_dict so we give Mongo what it wants
+            Nothing is read back from mongo, so the cost only depends on what changed, not on the size of the room
         """
-        LOGGER.info("Starting persist")
-        if (self.__mongo_collection.find_one({"room_name": self.__room_name}) is None):
-            self.__mongo_collection.insert_one(
-                {
-                    "room_name": self.__room_name,
-                    "owner_alias": self.__owner_alias,
-                    "room_type": self.__room_type,
-                    "member_list": self.__member_list,
-                    'deleted': self.__deleted,
-                    "create_time": self.__create_time,
-                    "modify_time": self.__modify_time,
-                }
-            )
-        else:
-            self.__mongo_collection.replace_one({"_id": self.__room_id},
-                                                {
-                "room_name": self.__room_name,
-                "owner_alias": self.__owner_alias,
-                "room_type": self.__room_type,
-                "member_list": self.__member_list,
-                'deleted': self.__deleted,
-                "create_time": self.__create_time,
-                "modify_time": self.__modify_time,
-            }, upsert=True)
-        self.__dirty = False
-        for message in list(self):
-            if message.dirty:
-                if message.mess_id is None or self.__mongo_collection.find_one({'_id': message.mess_id}) is None:
-                    message.sequence_num = self.__get_next_sequence_num()[self.room_name]
-                    serialized = message.to_dict()
-                    message.mess_id = self.__mongo_collection.insert_one(serialized).inserted_id
+        LOGGER.debug(f"Starting persist of {self.__room_name}")
+        if self.__dirty:
+            self.ensure_loaded()
+            # cleared before the write so a change made while it runs is written next time, set again if the write fails
+            self.__dirty = False
+            try:
+                self.__mongo_collection.replace_one({"room_name": self.__room_name}, self.__metadata(), upsert=True)
+            except Exception:
+                self.__dirty = True
+                raise
+        with self.__lock:
+            dirty_messages, self.__dirty_messages = self.__dirty_messages, []
+        if len(dirty_messages) == 0:
+            return
+        try:
+            new_messages = []
+            for message in dirty_messages:
+                if not message.dirty:
+                    continue  # listed twice or already written
+                if message.mess_id is None:
+                    if message.sequence_num < 0:
+                        message.sequence_num = self.__sequence.next()
+                        self.__on_numbered(message)
+                    new_messages.append(message)
                 else:
-                    serialized = message.to_dict()
-                    self.__mongo_collection.replace_one({'id': message.mess_id}, serialized, upsert=True)
-                message.dirty = False
+                    # changed messages, and new ones whose insert failed part way, are written by _id
+                    self.__mongo_collection.replace_one({'_id': message.mess_id}, message.to_dict(), upsert=True)
+                    message.dirty = False
+            self.__insert_messages(new_messages)
+        except Exception:
+            with self.__lock:
+                self.__dirty_messages[:0] = [message for message in dirty_messages if message.dirty]
+            raise
+
+    def persist_batch(self, messages: list):
+        """ write a batch of new messages with one insert_many. Called by the write-behind flusher
+            Messages sent through send_message already carry their sequence number, any others get a contiguous range
+
+        Args:
+            messages (list): new ChatMessage objects in send order
+        """
+        if len(messages) == 0:
+            return
+        unnumbered = [message for message in messages if message.sequence_num < 0]
+        if len(unnumbered) > 0:
+            first_sequence_num = self.__sequence.allocate(len(unnumbered))
+            for offset, message in enumerate(unnumbered):
+                message.sequence_num = first_sequence_num + offset
+                self.__on_numbered(message)
+        self.__insert_messages(messages)
+        LOGGER.debug(f'Wrote batch of {len(messages)} messages to {self.room_name}')
+        if len(self.__dirty_messages) > 0:
+            try:
+                self.persist()  # messages the flusher handed back earlier, mongo is reachable again
+            except Exception as problem:
+                LOGGER.warning(f'Could not write the messages handed back to {self.room_name}: {problem}')
+
+    def return_unwritten(self, messages: list) -> None:
+        """ take back messages the write-behind flusher gave up on. They are written by the next successful
+            persist_batch or persist of this room instead of being dropped
+
+        Args:
+            messages (list): ChatMessage objects that are still dirty
+        """
+        with self.__lock:
+            self.__dirty_messages.extend(message for message in messages if message.dirty)
+
+    def __insert_messages(self, messages: list) -> None:
+        """ insert new messages with one insert_many. Every message gets its _id before the first attempt, so when an
+            insert that partly went through (a BulkWriteError, or a timeout after the server wrote) is retried, the
+            documents already in mongo fail with a duplicate key error and are marked clean instead of being inserted twice
+            Messages that could not be written stay dirty and the error is raised for the caller to queue them again
+
+        Args:
+            messages (list): new ChatMessage objects
+        """
+        if len(messages) == 0:
+            return
+        for message in messages:
+            if message.mess_id is None:
+                message.mess_id = ObjectId()
+        documents = [dict(message.to_dict(), _id=message.mess_id) for message in messages]
+        try:
+            self.__mongo_collection.insert_many(documents, ordered=False)
+        except BulkWriteError as problem:
+            failed = {error['index'] for error in problem.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY_ERROR}
+            for index, message in enumerate(messages):
+                if index not in failed:
+                    message.dirty = False
+            if len(failed) > 0 or len(problem.details.get('writeConcernErrors', [])) > 0:
+                raise
+            LOGGER.info(f'{len(messages)} messages for {self.room_name} were already in mongo from an earlier attempt')
+            return
+        for message in messages:
+            message.dirty = False
+
+    def flush(self):
+        """ wait until every message queued by this process for write-behind is in mongo, then write the messages
+            the flusher handed back to this room
+        """
+        if self.__flusher is not None:
+            self.__flusher.flush()
+            self.persist()
 
     @STATSCLIENT.timer('get_messages')
-    def get_messages(self, user_alias: str, num_messages: int = -1, return_objects: bool=False) -> tuple:  # list of ChatMessage
+    def get_messages(self, user_alias: str, num_messages: int = -1, return_objects: bool=False, return_state: bool = False) -> tuple:  # list of ChatMessage
         """ get a list of messages or message objects
-            gets the messages from the right of the deque and doesnt display them if the sender
-            of the message is in the owner's blacklist
+            gets the newest messages from the right of the deque (newest first) and doesnt display them if the sender
+            of the message is in the user's blacklist. The blacklist is checked as a set and the filtered
+            result is cached per user until the room or that user's blacklist changes
         Args:
-            num_messages (int): number of messages
+            num_messages (int): number of messages, 0 or less for the whole history. Asking for more than the in memory
+                window holds (or for everything) pages the older messages from mongo
             return_objects (bool): whether to get ChatMessage or str
+            return_state (bool): also return the room state (last_sequence_num, version) the window was read at
 
         Returns:
             list: _description_
         """
         LOGGER.info('starting get_messages')
-        if user_alias not in self.member_list:  # TODO: propably should throw an exception here
+        self.ensure_loaded()
+        if not self.is_member(user_alias):  # TODO: propably should throw an exception here
             LOGGER.debug(f'Inside get_messages, user alias {user_alias} is not in the members list')
-            return [], [], 0
-        message_list = []
-        message_objects = []
+            return ([], [], 0, self.state) if return_state else ([], [], 0)
         if num_messages < 0:
             num_messages = 0
-        
-        for message in list(self)[-num_messages:]:
-            if (user := self.__user_list.get(user_alias)) is not None:
-                if message.mess_props.from_user in user.blacklist:
+        if (user := self.__user_list.get(user_alias)) is not None:
+            blacklist, blacklist_version = user.blacklist_set, user.blacklist_version
+        else:
+            blacklist, blacklist_version = set(), -1
+        cold_read = False
+        with self.__lock:
+            # the window is walked without copying it, so puts from other threads have to wait until the walk is done
+            state = (self.__sequence_index.last, self.__version)
+            view_key = (num_messages, blacklist_version, self.__version)
+            if (view := self.__filtered_views.get(user_alias)) is not None and view[0] == view_key:
+                self.__window_hits += 1
+                STATSCLIENT.incr('hot_window.hit')
+                message_list, message_objects = list(view[1]), list(view[2])
+            else:
+                message_list = []
+                message_objects = []
+                cold_read = (num_messages == 0 or num_messages > len(self)) and self.__has_cold_history
+                if cold_read:
+                    self.__window_misses += 1
+                    STATSCLIENT.incr('hot_window.miss')
+                    cold_count, oldest_seq = max(num_messages - len(self), 0), self[0].sequence_num if len(self) > 0 else -1
+                else:
+                    self.__window_hits += 1
+                    STATSCLIENT.incr('hot_window.hit')
+                if self.__columns is not None and not cold_read:
+                    # same messages as the deque path below (the newest num_messages rows), filtered with one array mask
+                    window = len(self) if num_messages == 0 else min(num_messages, len(self))
+                    rows = self.__columns.rows(self.__columns.mask(exclude_senders=blacklist), len(self) - window, window)
+                    message_objects = self.__columns.messages(rows[::-1])
+                    message_list = [message.message for message in message_objects]
+                else:
+                    for message in self.__tail(num_messages if num_messages > 0 else None):
+                        if message.mess_props.from_user in blacklist:
+                            continue
+                        message_objects.append(message)
+                        message_list.append(message.message)
+                if not cold_read:
+                    # cached per user, stale once the room changes (version) or the user's blacklist changes
+                    self.__filtered_views.pop(user_alias, None)
+                    if len(self.__filtered_views) >= FILTERED_VIEW_CACHE_SIZE:
+                        del self.__filtered_views[next(iter(self.__filtered_views))]
+                    self.__filtered_views[user_alias] = (view_key, list(message_list), list(message_objects))
+        if cold_read:
+            # older history is read from mongo after the lock is released
+            for message in self.__get_cold_messages(cold_count, oldest_seq):
+                if message.mess_props.from_user in blacklist:
                     continue
-            message_objects.append(message)
-            message_list.append(message.message)
+                message_objects.append(message)
+                message_list.append(message.message)
         STATSCLIENT.gauge('num_messages', len(message_list))
         total_messages = len(message_list)
-        if return_objects is True:
-            return message_list, message_objects, total_messages
+        result = (message_list, message_objects if return_objects is True else [], total_messages)
+        return result + (state,) if return_state else result
+
+    def get_messages_since(self, user_alias: str, after_seq: int, limit: int = -1, return_objects: bool = False, return_state: bool = False) -> tuple:
+        """ get the messages newer than after_seq, oldest first. Uses the sequence index to jump to after_seq,
+            so the work depends on the number of new messages rather than the size of the room
+        Args:
+            user_alias (str): member asking, messages from senders in their blacklist are skipped
+            after_seq (int): highest sequence number the caller already has
+            limit (int): return at most this many messages (the oldest new ones), -1 for no limit
+            return_objects (bool): whether to also return the ChatMessage objects
+            return_state (bool): also return the room state (last_sequence_num, version) the messages were read at
+
+        Returns:
+            tuple: (list of message text, list of ChatMessage or [], new high water mark). Pass the high water mark back
+                as after_seq to get the next messages
+        """
+        self.ensure_loaded()
+        if not self.is_member(user_alias):
+            LOGGER.debug(f'Inside get_messages_since, user alias {user_alias} is not in the members list')
+            return ([], [], after_seq, self.state) if return_state else ([], [], after_seq)
+        cold_messages = []
+        with self.__lock:
+            first_hot_seq = self.__sequence_index.first
+            state = (self.__sequence_index.last, self.__version)
+        if self.__has_cold_history and (first_hot_seq < 0 or first_hot_seq > after_seq + 1):
+            self.__window_misses += 1
+            STATSCLIENT.incr('hot_window.miss')
+            query = {"room_name": {"$exists": False}, "sequence_num": {"$gt": after_seq}}
+            if first_hot_seq >= 0:
+                query["sequence_num"]["$lt"] = first_hot_seq
+            cursor = self.__mongo_collection.find(query).sort("sequence_num", 1)
+            if limit > 0:
+                cursor = cursor.limit(limit)
+            cold_messages = [self.__message_from_dict(mess_dict) for mess_dict in cursor]
+        if limit > 0 and len(cold_messages) >= limit:
+            new_messages = cold_messages[:limit]
         else:
-            return message_list, [], total_messages
+            with self.__lock:
+                state = (self.__sequence_index.last, self.__version)
+                new_messages = cold_messages + self.__sequence_index.after(after_seq, limit - len(cold_messages) if limit > 0 else -1)
+        blacklist = user.blacklist_set if (user := self.__user_list.get(user_alias)) is not None else set()
+        message_list = []
+        message_objects = []
+        high_water_mark = after_seq
+        for message in new_messages:
+            high_water_mark = max(high_water_mark, message.sequence_num)
+            if message.mess_props.from_user in blacklist:
+                continue
+            message_objects.append(message)
+            message_list.append(message.message)
+        result = (message_list, message_objects if return_objects is True else [], high_water_mark)
+        return result + (state,) if return_state else result
 
     def send_message(self, message: str, from_alias: str):
         """add a message to the room and update mongo
@@ -386,6 +925,7 @@ class ChatRoom(deque):
         Returns:
             bool: returns true if successful
         """
+        self.ensure_loaded()
         new_mess_props = MessageProperties(
                 room_name = self.room_name,
                 mess_type = MESSAGE_TYPE_SENT,
@@ -395,82 +935,282 @@ class ChatRoom(deque):
                 rec_time = None,
             )
         message_object = ChatMessage(message, None, new_mess_props)
-        put_success = self.put(message_object)
-        self.persist()
+        if self.__flusher is not None and not self.__flusher.wait_for_room():
+            return False
+        with self.__lock:
+            message_object.sequence_num = self.__sequence.next()
+            put_success = self.put(message_object)
+        if put_success and self.__flusher is None:
+            self.persist()
         return put_success
 
+    def send_messages(self, messages: list) -> list:
+        """add several messages to the room at once. They get one contiguous range of sequence numbers
+        and, unless the room uses write-behind, are written with a single insert_many
+
+        Args:
+            messages (list): (message text, from alias) tuples in send order
+
+        Returns:
+            list: the ChatMessage for each message that was added, None where put failed
+        """
+        self.ensure_loaded()
+        if len(messages) == 0:
+            return []
+        sent_time = datetime.now()
+        message_objects = [ChatMessage(message, None, MessageProperties(
+                room_name = self.room_name,
+                mess_type = MESSAGE_TYPE_SENT,
+                to_user = self.room_name,
+                from_user = from_alias,
+                sent_time = sent_time,
+                rec_time = None,
+            )) for message, from_alias in messages]
+        if self.__flusher is not None and not self.__flusher.wait_for_room(len(message_objects)):
+            return [None] * len(message_objects)
+        results = []
+        with self.__lock:
+            first_sequence_num = self.__sequence.allocate(len(message_objects))
+            for offset, message_object in enumerate(message_objects):
+                message_object.sequence_num = first_sequence_num + offset
+                results.append(message_object if self.put(message_object) else None)
+        if self.__flusher is None and any(result is not None for result in results):
+            self.persist()
+        return results
+
     def find_message(self, message_text: str) -> ChatMessage:
         """ search for a message by text and return the ChatMessage object
             doesnt display them if the sender
-            of the message is in the owner's blacklist
+            of the message is in the owner's blacklist. Only messages containing every word of message_text
+            (found with the search index) are compared. History older than the window is looked up in mongo
         Args:
             message_text (str): search content
 
         Returns:
-            ChatMessage: return object
+            ChatMessage: return object, the newest match
         """
-        for message in super():
-            if message_text == message.message and message.from_user not in self.__user_list.get(self.__owner_alias).blacklist:
-                return message
+        self.ensure_loaded()
+        blacklist = owner.blacklist_set if (owner := self.__user_list.get(self.__owner_alias)) is not None else set()
+        with self.__lock:
+            if len(tokenize(message_text)) > 0:
+                candidates = (self.__sequence_index.get(sequence_num) for sequence_num in self.__search_index.search(message_text))
+            else:
+                candidates = reversed(self)
+            for message in candidates:
+                if message is not None and message_text == message.message and message.mess_props.from_user not in blacklist:
+                    return message
+            cold_query = self.__cold_query(blacklist)
+        if self.__has_cold_history:
+            cold_query["message"] = message_text
+            if (mess_dict := self.__mongo_collection.find_one(cold_query, sort=[("sequence_num", -1)])) is not None:
+                return self.__message_from_dict(mess_dict)
         LOGGER.warning(f"{message_text} not found")
 
-    def find_messages_by_user(self, user: str) -> list:
-        """ search for a message by sender and return the list of ChatMessage objects
-            doesnt display them if the sender
-            of the message is in the owner's blacklist
+    def __ensure_token_index(self) -> None:
+        """ create the multikey index on the message tokens the first time the history is searched, and add the
+            tokens to documents written before messages carried them, so older history can still be found
+        """
+        if self.__token_index_ready:
+            return
+        self.__mongo_collection.create_index([("tokens", 1), ("sequence_num", -1)])
+        untokenized = self.__mongo_collection.find({"room_name": {"$exists": False}, "tokens": {"$exists": False}}, {"message": 1})
+        updates = [UpdateOne({"_id": mess_dict["_id"]}, {"$set": {"tokens": sorted(set(tokenize(mess_dict.get("message"))))}})
+                   for mess_dict in untokenized]
+        if len(updates) > 0:
+            self.__mongo_collection.bulk_write(updates, ordered=False)
+            LOGGER.info(f'added search tokens to {len(updates)} older messages of {self.room_name}')
+        self.__token_index_ready = True
+
+    def __cold_query(self, blacklist: set) -> dict:
+        """ mongo filter for the messages older than the window, leaving out senders in the blacklist
+        """
+        query = {"room_name": {"$exists": False}}
+        if (first_hot_seq := self.__sequence_index.first) >= 0:
+            query["sequence_num"] = {"$lt": first_hot_seq}
+        if len(blacklist) > 0:
+            query["mess_props.from_user"] = {"$nin": list(blacklist)}
+        return query
+
+    @STATSCLIENT.timer('search_messages')
+    def search_messages(self, user_alias: str, query: str, limit: int = SEARCH_DEFAULT_LIMIT, include_history: bool = True) -> list:
+        """ full text search of the messages in the window using the room's inverted index. Every term of the query
+            has to match a word of the message, a term ending in * matches words starting with it.
+            Messages from senders in the user's blacklist and removed messages are left out
+            When the window has fewer than limit matches and the room has older history, mongo is searched for the rest,
+            newest first, through the multikey index on the tokens stored with each message. Exact terms have to all be
+            in the tokens, a prefix term matches a token with an anchored regex, and each candidate is checked against the
+            terms like the index does
         Args:
-            user (str): search content
+            user_alias (str): member searching
+            query (str): search terms, e.g. 'deploy fri*'
+            limit (int): return at most this many messages, 0 or less for no limit
+            include_history (bool): also search the history older than the window, False for the window only
 
         Returns:
-            list: list of ChatMessage objects
+            list: matching ChatMessage objects, newest first
         """
+        self.ensure_loaded()
+        if not self.is_member(user_alias):
+            LOGGER.debug(f'Inside search_messages, user alias {user_alias} is not in the members list')
+            return []
+        blacklist = user.blacklist_set if (user := self.__user_list.get(user_alias)) is not None else set()
         message_list = []
-        for message in super():
-            if user == message.from_user and message.from_user not in self.__user_list.get(self.__owner_alias).blacklist and not message.removed:
+        with self.__lock:
+            for sequence_num in self.__search_index.search(query):
+                message = self.__sequence_index.get(sequence_num)
+                if message is None or message.removed or message.mess_props.from_user in blacklist:
+                    continue
                 message_list.append(message)
+                if 0 < limit <= len(message_list):
+                    return message_list
+            cold_query = self.__cold_query(blacklist)
+        if include_history and self.__has_cold_history and len(terms := parse_query(query)) > 0:
+            self.__ensure_token_index()
+            cold_query["removed"] = {"$ne": True}
+            exact_terms = [token for token, is_prefix in terms if not is_prefix]
+            token_filters = [{"tokens": {"$all": exact_terms}}] if len(exact_terms) > 0 else []
+            token_filters += [{"tokens": {"$regex": f'^{re.escape(token)}'}} for token, is_prefix in terms if is_prefix]
+            cold_query["$and"] = token_filters
+            for mess_dict in self.__mongo_collection.find(cold_query).sort("sequence_num", -1):
+                if not matches(terms, mess_dict["message"]):
+                    continue
+                message_list.append(self.__message_from_dict(mess_dict))
+                if 0 < limit <= len(message_list):
+                    break
         return message_list
 
-    def remove_messages_by_user(self, user: str) -> list:
+    def find_messages_by_user(self, user: str) -> list:
         """ search for a message by sender and return the list of ChatMessage objects
             doesnt display them if the sender
-            of the message is in the owner's blacklist
+            of the message is in the owner's blacklist. Uses the per sender index, so the cost depends
+            on how many messages that sender has in the window
         Args:
             user (str): search content
 
         Returns:
-            list: list of ChatMessage objects
+            list: list of ChatMessage objects, newest first
         """
-        message_list = []
-        for message in super():
-            if user == message.from_user and message.from_user not in self.__user_list.get(self.__owner_alias).blacklist:
-                message.removed = True
+        self.ensure_loaded()
+        if (owner := self.__user_list.get(self.__owner_alias)) is not None and user in owner.blacklist_set:
+            return []
+        with self.__lock:
+            if self.__columns is not None:
+                rows = self.__columns.rows(self.__columns.mask(sender=user, include_removed=False))
+                return self.__columns.messages(rows[::-1])
+            return [message for message in reversed(self.__messages_by_sender.get(user, ())) if not message.removed]
+
+    def remove_messages_by_user(self, user: str) -> list:
+        """ flag every message from a sender as removed and return the list of ChatMessage objects flagged in memory
+            doesnt remove them if the sender
+            of the message is in the owner's blacklist. The window is updated through the per sender index and
+            mongo (including the history outside the window) with a single update_many
+        Args:
+            user (str): search content
+
+        Returns:
+            list: list of ChatMessage objects, newest first
+        """
+        self.ensure_loaded()
+        if (owner := self.__user_list.get(self.__owner_alias)) is not None and user in owner.blacklist_set:
+            return []
+        with self.__lock:
+            if self.__columns is not None:
+                rows = self.__columns.rows(self.__columns.mask(sender=user, include_removed=False))
+                message_list = self.__columns.set_removed(rows[::-1])
+            else:
+                message_list = [message for message in reversed(self.__messages_by_sender.get(user, ())) if not message.removed]
+                for message in message_list:
+                    message.removed = True
+            self.__version += 1
+        result = self.__mongo_collection.update_many(
+            {"room_name": {"$exists": False}, "mess_props.from_user": user, "removed": {"$ne": True}},
+            {"$set": {"removed": True}})
+        LOGGER.info(f'Removed messages from {user} in {self.room_name}: {len(message_list)} in memory, {result.modified_count} in mongo')
         return message_list
 
+    def find_messages_by_time(self, start_time: datetime = None, end_time: datetime = None) -> list:
+        """ messages in the window sent at or after start_time and before end_time, newest first
+
+        Args:
+            start_time (datetime): earliest sent time, None for no lower bound
+            end_time (datetime): sent time to stop before, None for no upper bound
+
+        Returns:
+            list: list of ChatMessage objects
+        """
+        self.ensure_loaded()
+        with self.__lock:
+            if self.__columns is not None:
+                rows = self.__columns.rows(self.__columns.mask(start_time=start_time, end_time=end_time))
+                return self.__columns.messages(rows[::-1])
+            message_list = []
+            for message in reversed(self):
+                sent_time = message.mess_props.sent_time
+                if sent_time is None or (start_time is not None and sent_time < start_time) or (end_time is not None and sent_time >= end_time):
+                    continue
+                message_list.append(message)
+            return message_list
+
     def get(self) -> ChatMessage:
         """return last object
 
         Returns:
-            ChatMessage: return object
+            ChatMessage: return object, the newest message in the room or None if it has none
         """
-        return super()[-1]
+        self.ensure_loaded()
+        with self.__lock:
+            return self[-1] if len(self) > 0 else None
 
-    def put(self, message: ChatMessage) -> bool:
+    def __tail(self, count: int = None):
+        """ iterate over the newest messages, newest first, without copying the deque
+            A put from another thread breaks the iteration (deque mutated during iteration), so the caller has to
+            hold the room lock until it is done, as get_messages does
+
+        Args:
+            count (int): how many messages at most, None for the whole window
+
+        Returns:
+            iterator: ChatMessage objects, newest first
+        """
+        return islice(reversed(self), count)
+
+    def put(self, message: ChatMessage, notify: bool = True) -> bool:
         """ adds a ChatMessage to the deque
-            puts message into the (left of the) deque
+            puts message into the (right of the) deque, so the newest message is self[-1]. A new (dirty) message is either handed to the
+            write-behind flusher or remembered for the next persist. Runs under the room lock, as does the eviction it triggers,
+            so the flusher is never waited on here: callers wait for space first (see send_message) and a full queue fails the put
 
         Args:
             message (ChatMessage): message object
+            notify (bool): publish the message to the room's stream subscribers, off while restoring
 
         Returns:
-            bool: returns true if successful
+            bool: returns true if successful, false if the write-behind queue rejected the message
         """
-        if message is not None:
-            super().appendleft(message)
-            return True
-        else:
+        if message is None:
             return False
+        message.encode()
+        with self.__lock:
+            if message.dirty:
+                if self.__flusher is not None and message.mess_id is None:
+                    if not self.__flusher.submit(self, message, block=False):
+                        return False
+                else:
+                    self.__dirty_messages.append(message)
+            self.__evict()
+            super().append(message)
+            self.__sequence_index.add(message)
+            self.__search_index.add(message)
+            self.__messages_by_sender.setdefault(message.mess_props.from_user, deque()).append(message)
+            if self.__columns is not None:
+                self.__columns.append(message)
+            self.__version += 1
+            if notify:
+                MESSAGE_BROKER.publish(self.__room_name, message)
+        return True
 
     def length(self) -> int:
+        self.ensure_loaded()
         return len(self)
 
 
@@ -478,13 +1218,24 @@ class RoomList():
     """class to hold and manage the list of rooms available.
     """
 
-    def __init__(self, name: str = DEFAULT_ROOM_LIST_NAME):
+    def __init__(self, name: str = DEFAULT_ROOM_LIST_NAME, user_list: UserList = None, write_behind: bool = WRITE_BEHIND_ENABLED):
         self.__name = name
+        self.__user_list = user_list if user_list is not None else shared_user_list()
+        self.__write_behind = write_behind
         self.__room_list = list()
         self.__rooms_metadata = list()
-        self.__mongo_client = MongoClient(host=MONGO_HOST, port=MONGO_PORT, username=USERNAME, password=PASSWORD, authSource='cpsc313', authMechanism='SCRAM-SHA-256')
+        self.__rooms_by_name = dict()
+        self.__rooms_by_owner = dict()
+        self.__rooms_by_member = dict()
+        self.__metadata_by_name = dict()
+        # guards the room list and its indexes, rooms are added, removed and joined from several request threads
+        self.__lock = threading.RLock()
+        # keeps member list writes in the order their snapshots were taken, taken before the list lock
+        self.__members_write_lock = threading.Lock()
+        self.__mongo_client = MONGO_CLIENTS.get_client()
         self.__mongo_db = self.__mongo_client[MONGO_DB_NAME]
         self.__mongo_collection = self.__mongo_db[DEFAULT_ROOM_LIST_NAME]
+        self.__user_list.subscribe(self.__on_user_changed)
 
         if self.__mongo_collection is None:
             self.__mongo_collection = self.__mongo_db.create_collection(self.name)
@@ -505,37 +1256,46 @@ class RoomList():
     def room_list(self):
         return self.__room_list
 
+    @property
+    def user_list(self):
+        return self.__user_list
+
     def create(self, room_name: str, owner_alias: str, member_list: list = None, room_type: int = ROOM_TYPE_PRIVATE) -> ChatRoom:
         """ Create a new chatroom. First check to see if a room exists with that name, and if so, bail. """
         if self.get(room_name=room_name) is not None:
             LOGGER.debug(f'Trying to create, room_name: {room_name} already exists')
             return None
-        new_room = ChatRoom(room_name=room_name, owner_alias=owner_alias, member_list=member_list, room_type=room_type, create_new=True)
-        self.add(new_room=new_room)
+        new_room = ChatRoom(room_name=room_name, owner_alias=owner_alias, member_list=member_list, room_type=room_type, create_new=True, user_list=self.__user_list, write_behind=self.__write_behind)
+        if not self.add(new_room=new_room):
+            return None
         return new_room
 
-    def add(self, new_room: ChatRoom):
+    def add(self, new_room: ChatRoom) -> bool:
         """adds ChatRoom object to the room list after checking if it already exists.
+            The check and the add happen under the list lock, so of two concurrent adds with the same name only one wins
 
         Args:
             new_room (ChatRoom): room to be added to the room list
-        """
-        if self.get(room_name=new_room.room_name) is not None:
-            LOGGER.debug(f'Trying to add, room_name: {new_room.room_name} already exists')
-            return
 
-        self.__room_list.append(new_room)
-        if self.find_room_in_metadata(new_room.room_name) is None:
-            self.__rooms_metadata.append({'room_name': new_room.room_name, 'room_type': new_room.room_type, 'owner_alias': new_room.owner_alias, 'member_list': new_room.member_list})
-        self.__modify_time = datetime.now()
-        self.__dirty = True
+        Returns:
+            bool: False if a room with that name already exists
+        """
+        with self.__lock:
+            if self.get(room_name=new_room.room_name) is not None:
+                LOGGER.debug(f'Trying to add, room_name: {new_room.room_name} already exists')
+                return False
+            self.__track(new_room)
+            if self.find_room_in_metadata(new_room.room_name) is None:
+                room_dict = {'room_name': new_room.room_name, 'room_type': new_room.room_type, 'owner_alias': new_room.owner_alias, 'member_list': new_room.member_list}
+                self.__rooms_metadata.append(room_dict)
+                self.__metadata_by_name[new_room.room_name] = room_dict
+            self.__modify_time = datetime.now()
+            self.__dirty = True
         self.__persist()
+        return True
 
     def find_room_in_metadata(self, room_name: str) -> dict:
-        for room_dict in self.__rooms_metadata:
-            if room_dict['room_name'] == room_name:
-                return room_dict
-        return None
+        return self.__metadata_by_name.get(room_name)
 
     def remove(self, room_name: str):
         """remove first occurrence of a room matching the given room_name
@@ -543,13 +1303,19 @@ class RoomList():
         Args:
             room (str): name of room
         """
-        for room in self.__room_list:
-            if room.room_name == room_name:
-                room.removed = True
-                self.__modify_time = datetime.now()
-                self.__persist()
+        with self.__lock:
+            if (room := self.__rooms_by_name.pop(room_name, None)) is None:
+                LOGGER.warning(f'Room {room_name} not found in {self.__name}')
                 return
-        LOGGER.warning(f'Room {room} not found in {self.__room_list}')
+            room.removed = True
+            if (owner_rooms := self.__rooms_by_owner.get(room.owner_alias)) is not None:
+                owner_rooms.pop(room_name, None)
+                if len(owner_rooms) == 0:
+                    del self.__rooms_by_owner[room.owner_alias]
+            for member_name in room.member_list:
+                self.__unindex_member(room, member_name)
+            self.__modify_time = datetime.now()
+        self.__persist()
 
     def get(self, room_name: str) -> ChatRoom:
         """Find a room by the room name
@@ -560,10 +1326,9 @@ class RoomList():
         Returns:
             ChatRoom: found object
         """
-        for room in self.__room_list:
-            if room.room_name == room_name and not room.removed:
-                return room
-        LOGGER.warning(f'Room {room_name} not found in {self.__room_list}')
+        if (room := self.__rooms_by_name.get(room_name)) is not None and not room.removed:
+            return room
+        LOGGER.debug(f'Room {room_name} not found in {self.__name}')
 
     def find_by_member(self, member: str) -> list:
         """ finds all rooms in the room_list that have the given member in them.
@@ -574,12 +1339,76 @@ class RoomList():
         Returns:
             list: list of rooms with member in them
         """
-        found_room_list = []
-        for room in self.__room_list:
-            found_member = room.member_list.find(member)
-            if found_member is not None and not room.removed:
-                found_room_list.append(room)
-        return found_room_list
+        with self.__lock:
+            return [room for room in self.__rooms_by_member.get(member, dict()).values() if not room.removed]
+
+    def __track(self, room: ChatRoom) -> None:
+        """ add a room to the list and the name, owner and member indexes, and follow its membership changes
+        """
+        self.__room_list.append(room)
+        self.__rooms_by_name[room.room_name] = room
+        self.__rooms_by_owner.setdefault(room.owner_alias, dict())[room.room_name] = room
+        for member_name in room.member_list:
+            self.__index_member(room, member_name)
+        room.add_observer(self.__on_room_changed)
+        room.detach_user_list()
+
+    def __index_member(self, room: ChatRoom, member_name: str) -> None:
+        self.__rooms_by_member.setdefault(member_name, dict())[room.room_name] = room
+
+    def __unindex_member(self, room: ChatRoom, member_name: str) -> None:
+        if (member_rooms := self.__rooms_by_member.get(member_name)) is not None and member_rooms.get(room.room_name) is room:
+            del member_rooms[room.room_name]
+            if len(member_rooms) == 0:
+                del self.__rooms_by_member[member_name]
+
+    def __on_room_changed(self, event: str, room: ChatRoom, member_name: str) -> None:
+        """ called by a room when a member joins or leaves. Keeps the member index and the room's metadata current,
+            and writes the new member list to mongo so a restart restores the rooms with their current members
+        """
+        if room.removed:
+            return
+        with self.__lock:
+            if event == ROOM_EVENT_MEMBER_ADDED:
+                self.__index_member(room, member_name)
+            elif event == ROOM_EVENT_MEMBER_REMOVED:
+                self.__unindex_member(room, member_name)
+            if (room_dict := self.find_room_in_metadata(room.room_name)) is None:
+                return
+            if room_dict['member_list'] is not room.member_list:
+                room_dict['member_list'] = list(room.member_list)
+            self.__modify_time = datetime.now()
+            self.__dirty = True
+        self.__persist_members(room.room_name)
+
+    def __persist_members(self, room_name: str) -> None:
+        """ write one room's member list into the room list document, without rewriting the rest of the list.
+            Falls back to persisting the whole list when the document does not have the room yet
+
+        Args:
+            room_name (str): room whose members changed
+        """
+        with self.__members_write_lock:
+            with self.__lock:
+                if (room_dict := self.find_room_in_metadata(room_name)) is None:
+                    return
+                member_list = list(room_dict['member_list'])
+                modify_time = self.__modify_time
+            result = self.__mongo_collection.update_one({"list_name": self.__name, "rooms_metadata.room_name": room_name},
+                                                        {"$set": {"rooms_metadata.$.member_list": member_list, "modify_time": modify_time}})
+        if result.matched_count == 0:
+            self.__persist()
+
+    def __on_user_changed(self, event: str, user: ChatUser) -> None:
+        """ called by the user list when a user changes. A deregistered user leaves every room the member index has them in
+        """
+        if event != USER_EVENT_DEREGISTER:
+            return
+        with self.__lock:
+            member_rooms = list(self.__rooms_by_member.get(user.alias, dict()).values())
+        for room in member_rooms:
+            LOGGER.debug(f'{user.alias} was deregistered, removing from room {room.room_name}')
+            room.remove_group_member(user.alias)
 
     def find_by_owner(self, owner: str) -> list:
         """ finds all rooms in the room_list that have the given owner.
@@ -590,11 +1419,8 @@ class RoomList():
         Returns:
             list: list of rooms with owner in them
         """
-        found_room_list = []
-        for room in self.__room_list:
-            if room.owner_alias == owner and not room.removed:
-                found_room_list.append(room)
-        return found_room_list
+        with self.__lock:
+            return [room for room in self.__rooms_by_owner.get(owner, dict()).values() if not room.removed]
 
     def __persist(self):
         """ Save a document that describes the room list (name of list, create, modify times, and metadata).
@@ -624,9 +1450,10 @@ class RoomList():
 
     def __restore(self):
         """ Get the document for the list itself, which will have the room list metadata
+            Rooms are created from that metadata without reading their messages, so startup does not depend on message volume
         """
         LOGGER.info("Restoring room list from Mongo")
-        list_data = self.__mongo_collection.find_one({"list_name": {"$exists": 'true'}})
+        list_data = self.__mongo_collection.find_one({"list_name": self.__name})
         if list_data is None:
             LOGGER.warning("room list not found")
             return False
@@ -636,9 +1463,13 @@ class RoomList():
         self.__modify_time = list_data['modify_time']
         self.__rooms_metadata = list_data['rooms_metadata']
         for room_dict in self.__rooms_metadata:
-            if (new_room := ChatRoom(room_name=room_dict['room_name'], owner_alias=room_dict['owner_alias'], member_list=room_dict['member_list'], room_type=room_dict['room_type'], create_new=False)) is None:
-                new_room = self.create(room_name=room_dict['room_name'], owner_alias=room_dict['owner_alias'], member_list=room_dict['member_list'], room_type=room_dict['room_type'])
-            self.add(new_room=new_room)
+            self.__metadata_by_name.setdefault(room_dict['room_name'], room_dict)
+        for room_dict in self.__rooms_metadata:
+            if self.get(room_name=room_dict['room_name']) is not None:
+                continue
+            # lazy rooms only hold this metadata until their messages are first used, see ChatRoom.ensure_loaded
+            new_room = ChatRoom(room_name=room_dict['room_name'], owner_alias=room_dict['owner_alias'], member_list=room_dict['member_list'], room_type=room_dict['room_type'], create_new=False, user_list=self.__user_list, write_behind=self.__write_behind, lazy=True)
+            self.__track(new_room)
         LOGGER.info("Done restoring room list from Mongo")
         return True
 
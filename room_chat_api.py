@@ -5,28 +5,41 @@
 
     fast api implementation for message chat
 """
+import asyncio
+import hashlib
+import json
 from datetime import datetime, timedelta
 
 import fastapi as fa
-from fastapi import Depends, FastAPI, Form, HTTPException, Request, status
-from fastapi.responses import JSONResponse, Response
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
 from constants import *
+from executors import HASH_EXECUTOR, IO_EXECUTOR
+from mongo_pool import MONGO_CLIENTS
+from pubsub import MESSAGE_BROKER
 from room import *
+from write_behind import WRITE_BEHIND
 from users import *
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, filename='room_chat_test.log')
 
 app = fa.FastAPI()
-room_list = RoomList()
-users = UserList()
+users = shared_user_list()
+room_list = RoomList(user_list=users)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = 12
+# rounds is the cost of new hashes. min and max pin it, so verify_and_update always replaces a hash made with another cost
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+STREAM_KEEPALIVE_SECONDS = 15
+LONG_POLL_MAX_WAIT = 60
+MESSAGE_BATCH_MAX = 1000
 
 
 class Token(BaseModel):
@@ -39,6 +52,20 @@ class LoginForm(BaseModel):
     password: str
 
 
+class BatchMessage(BaseModel):
+    room_name: str
+    message: str
+    from_alias: str
+    to_alias: str | None = None
+
+
+class BatchMessageResult(BaseModel):
+    index: int
+    status_code: int
+    detail: str
+    sequence_num: int | None = None
+
+
 """ Some utility functions for Auth
 """
 
@@ -51,15 +78,77 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def authenticate_user(username: str, password: str):
+async def authenticate_user(username: str, password: str):
+    """ check a password against the hash stored for the user. bcrypt runs on HASH_EXECUTOR so a burst of logins
+        queues there instead of blocking the event loop. A hash made with a different number of rounds than
+        BCRYPT_ROUNDS is replaced on a successful login
+    """
     user = users.get(username)
-    if not user:
+    if not user or not user.hash_pass:
         return False
-    if not verify_password(password, get_password_hash(password)):
+    STATSCLIENT.gauge('login.hash_queue_depth', HASH_EXECUTOR.pending + HASH_EXECUTOR.waiting)
+    with STATSCLIENT.timer('login.verify'):
+        verified, new_hash = await HASH_EXECUTOR.run(pwd_context.verify_and_update, password, user.hash_pass)
+    if not verified:
         return False
+    if new_hash is not None:
+        LOGGER.debug(f'Rehashing password for {username} with {BCRYPT_ROUNDS} rounds')
+        user.hash_pass = new_hash
+        await IO_EXECUTOR.run(users.persist)
     return user
 
 
+async def get_loaded_room(room_name: str) -> ChatRoom:
+    """ find a room and load it first if it is lazy. Membership checks then use the room's own document instead of the
+        member list in the room list metadata, which can be behind it
+
+    Returns:
+        ChatRoom: the loaded room or None if there is no room with that name
+    """
+    if (room_instance := room_list.get(room_name=room_name)) is not None and not room_instance.loaded:
+        await IO_EXECUTOR.run(room_instance.ensure_loaded)
+    return room_instance
+
+
+class RawJSONResponse(Response):
+    """ JSON response for bodies that are already encoded (see messages_json), anything else is encoded with encode_json
+    """
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return content if isinstance(content, bytes) else encode_json(content)
+
+
+def messages_json(message_objects: list, full: bool = False) -> bytes:
+    """ JSON array of messages joined from the bytes each ChatMessage caches, nothing is encoded again
+
+    Args:
+        message_objects (list): ChatMessage objects in response order
+        full (bool): objects with sequence_num, from_user, sent_time and message instead of just the message text
+    """
+    if full:
+        return b'[' + b','.join(message.full_json_bytes for message in message_objects) + b']'
+    return b'[' + b','.join(message.json_bytes for message in message_objects) + b']'
+
+
+def messages_etag(room_name: str, state: tuple, user: ChatUser, *window) -> str:
+    """ ETag of a GET /messages response. It changes when a message is put or changed in the room, when the caller's
+        blacklist changes or when a different window (messages_to_get, after_seq, limit) is asked for. state is the
+        room's (last_sequence_num, version) snapshot, the one the response body was read at
+    """
+    last_seq, version = state
+    key = f'{room_name}|{last_seq}|{version}|{user.alias}|{user.blacklist_version}|'
+    key += '|'.join(str(part) for part in window)
+    return f'"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -100,7 +189,8 @@ def fake_hashed_password(password: str):
 """
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    with STATSCLIENT.timer('login'):
+        user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -139,33 +229,149 @@ async def read_items(token: str = Depends(oauth2_scheme)):
 
 
 @app.get("/messages", status_code=200)
-def receive_messages(request: Request, alias: str, room_name: str, messages_to_get: int = -1):
+async def receive_messages(request: Request, alias: str, room_name: str, messages_to_get: int = -1, after_seq: int = None, limit: int = -1, wait: float = 0,
+                           full: bool = False, if_none_match: str = Header(None)):
     """api endpoint to get messages from the MongoDB server
 
     Args:
         room_name (str): name of the room
         messages_to_get (int): number of messages to return from the deque
+        after_seq (int): only return messages with a higher sequence number, oldest first. Use the
+            X-Last-Sequence-Num header of the previous response to fetch only what is new
+        limit (int): with after_seq, return at most this many messages
+        wait (float): with after_seq, seconds to hold the request open (long poll, at most LONG_POLL_MAX_WAIT) when there is
+            nothing new yet. It returns as soon as a new message arrives, or with an empty list when the time runs out
+        if_none_match (str): If-None-Match header, the ETag of the caller's last response. When nothing it depends on changed
+            the answer is an empty 304 (keep the X-Last-Sequence-Num you have). Not used for long polls
+        full (bool): return message objects (sequence_num, from_user, sent_time, message) instead of the message texts
 
     Returns:
-        list: list of ChatMessages
+        list: list of message texts, or of message objects with full
     """
     LOGGER.info("starting GET MESSAGES")
-    if (room_instance := room_list.get(room_name=room_name)) is None:
+    if (room_instance := await get_loaded_room(room_name)) is None:
         LOGGER.debug(f'in GET MESSAGES - ROOM DOES NOT EXIST: {room_name}')
         return JSONResponse(status_code=450, content=f"Room {room_name} does not exist")
-    if users.get(alias) is None:
+    if (user := users.get(alias)) is None:
         LOGGER.debug(f'in GET MESSAGES - ALIAS DOES NOT EXIST: {alias}')
         return JSONResponse(status_code=455, content=f'alias {alias} does not exist')
-    if alias not in room_instance.member_list:
+    if not room_instance.is_member(alias):
         LOGGER.debug(f'in GET MESSAGES - ALIAS: {alias} is not part of ROOM: {room_name}')
         return JSONResponse(status_code=445, content=f'alias {alias} is not a member of room {room_name}')
-    messages, message_objects, total_mess = room_instance.get_messages(user_alias=alias, num_messages=messages_to_get, return_objects=True)
+    long_poll = after_seq is not None and wait > 0
+    if not long_poll:
+        etag = messages_etag(room_name, room_instance.state, user, messages_to_get, after_seq, limit, full)
+        if etag_matches(if_none_match, etag):
+            LOGGER.debug(f'in GET MESSAGES - NOT MODIFIED for {alias} in room: {room_name}')
+            return Response(status_code=304, headers={'ETag': etag})
+    if after_seq is not None:
+        messages, message_objects, last_seq, state = await IO_EXECUTOR.run(room_instance.get_messages_since, user_alias=alias, after_seq=after_seq, limit=limit, return_objects=True, return_state=True)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(wait, LONG_POLL_MAX_WAIT)
+        while len(messages) == 0 and (remaining := deadline - loop.time()) > 0:
+            seen_seq = last_seq
+            if not await MESSAGE_BROKER.wait(room_name, remaining, lambda: room_instance.last_sequence_num > seen_seq):
+                break
+            messages, message_objects, last_seq, state = await IO_EXECUTOR.run(room_instance.get_messages_since, user_alias=alias, after_seq=last_seq, limit=limit, return_objects=True, return_state=True)
+    else:
+        # the high water mark comes from the same locked read as the messages, so a put landing in between can't be skipped
+        messages, message_objects, total_mess, state = await IO_EXECUTOR.run(room_instance.get_messages, user_alias=alias, num_messages=messages_to_get, return_objects=True, return_state=True)
+        last_seq = state[0]
+    headers = {'X-Last-Sequence-Num': str(last_seq), 'ETag': messages_etag(room_name, state, user, messages_to_get, after_seq, limit, full)}
     LOGGER.debug(f'in GET MESSAGES - after getting messages for room: {room_name}\n messages are {messages}')
     for message in message_objects:
         LOGGER.debug(f'GET MESSAGES - Message: {message.message} == message props: {message.mess_props} host is {request.client.host}')
-        LOGGER.debug(request.json())
     LOGGER.info("End GET MESSAGES")
-    return messages
+    return RawJSONResponse(content=messages_json(message_objects, full), headers=headers)
+
+@app.get("/search", status_code=200)
+async def search_messages(request: Request, alias: str, room_name: str, q: str, limit: int = SEARCH_DEFAULT_LIMIT, history: bool = True):
+    """api endpoint to search the messages of a room
+
+    Args:
+        alias (str): member searching, senders in their blacklist are left out
+        room_name (str): name of the room
+        q (str): search terms, every term has to match and a term ending in * matches words starting with it
+        limit (int): return at most this many messages
+        history (bool): also search mongo for messages older than the in memory window, False for the window only
+
+    Returns:
+        list: matching messages, newest first
+    """
+    LOGGER.info("starting SEARCH")
+    if (room_instance := await get_loaded_room(room_name)) is None:
+        LOGGER.debug(f'in SEARCH - ROOM DOES NOT EXIST: {room_name}')
+        return JSONResponse(status_code=450, content=f"Room {room_name} does not exist")
+    if users.get(alias) is None:
+        LOGGER.debug(f'in SEARCH - ALIAS DOES NOT EXIST: {alias}')
+        return JSONResponse(status_code=455, content=f'alias {alias} does not exist')
+    if not room_instance.is_member(alias):
+        LOGGER.debug(f'in SEARCH - ALIAS: {alias} is not part of ROOM: {room_name}')
+        return JSONResponse(status_code=445, content=f'alias {alias} is not a member of room {room_name}')
+    results = await IO_EXECUTOR.run(room_instance.search_messages, user_alias=alias, query=q, limit=limit, include_history=history)
+    LOGGER.debug(f'in SEARCH - {len(results)} results for {q} in room: {room_name}')
+    LOGGER.info("End SEARCH")
+    return RawJSONResponse(content=messages_json(results, full=True))
+
+
+@app.get("/rooms/{room_name}/stream", status_code=200)
+async def stream_messages(request: Request, room_name: str, alias: str, last_event_id: int = Header(None)):
+    """api endpoint that pushes new messages of a room as server-sent events
+
+    Args:
+        room_name (str): name of the room
+        alias (str): member listening, messages from senders in their blacklist are not sent
+        last_event_id (int): Last-Event-ID header sent by a reconnecting client, messages after it are sent first
+
+    Returns:
+        StreamingResponse: text/event-stream with one 'message' event per new message (the id is its sequence number)
+            and a 'dropped' event when the client fell so far behind that messages were skipped. Membership is checked
+            again before every message and keep-alive, a member who leaves the room or is deregistered gets a 'closed'
+            event instead and the stream ends
+    """
+    LOGGER.info("starting STREAM")
+    if (room_instance := await get_loaded_room(room_name)) is None:
+        LOGGER.debug(f'in STREAM - ROOM DOES NOT EXIST: {room_name}')
+        return JSONResponse(status_code=450, content=f"Room {room_name} does not exist")
+    if (user := users.get(alias)) is None:
+        LOGGER.debug(f'in STREAM - ALIAS DOES NOT EXIST: {alias}')
+        return JSONResponse(status_code=455, content=f'alias {alias} does not exist')
+    if not room_instance.is_member(alias):
+        LOGGER.debug(f'in STREAM - ALIAS: {alias} is not part of ROOM: {room_name}')
+        return JSONResponse(status_code=445, content=f'alias {alias} is not a member of room {room_name}')
+    def still_member() -> bool:
+        return not user.removed and not room_instance.removed and room_instance.is_member(alias)
+
+    def message_event(message: ChatMessage) -> str:
+        return f'id: {message.sequence_num}\nevent: message\ndata: {message.full_json_bytes.decode()}\n\n'
+
+    async def event_stream():
+        # subscribing happens once the response starts, so a client gone before then leaves no subscription behind.
+        # The replay comes after the subscribe, a message put in between is in both and the live copy is skipped
+        subscription = MESSAGE_BROKER.subscribe(room_name, skip=lambda message: message.mess_props.from_user in user.blacklist_set)
+        try:
+            replayed_seq = last_event_id
+            if last_event_id is not None:
+                missed_text, missed_messages, replayed_seq = await IO_EXECUTOR.run(room_instance.get_messages_since, user_alias=alias, after_seq=last_event_id, return_objects=True)
+                for message in missed_messages:
+                    yield message_event(message)
+            while True:
+                message = await subscription.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                if not still_member():
+                    LOGGER.debug(f'in STREAM - {alias} is no longer a member of room: {room_name}, closing')
+                    yield f'event: closed\ndata: {json.dumps({"reason": f"{alias} is not a member of room {room_name}"})}\n\n'
+                    return
+                if (dropped := subscription.take_dropped()) > 0:
+                    yield f'event: dropped\ndata: {json.dumps({"dropped": dropped})}\n\n'
+                if message is None:
+                    yield ': keep-alive\n\n'
+                elif replayed_seq is None or message.sequence_num > replayed_seq:
+                    yield message_event(message)
+        finally:
+            MESSAGE_BROKER.unsubscribe(subscription)
+            LOGGER.debug(f'in STREAM - {alias} disconnected from room: {room_name}')
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.post("/message", status_code=201)
 async def send_message(request: Request, room_name: str, message: str, from_alias: str, to_alias: str):
@@ -177,37 +383,85 @@ async def send_message(request: Request, room_name: str, message: str, from_alia
         message (str): message text
         from_alias (str): sender
     """    
-    if (room_instance := room_list.get(room_name=room_name)) is None:
+    if (room_instance := await get_loaded_room(room_name)) is None:
         LOGGER.debug(f'In POST MESSAGE - ROOM does not exist: {message} == room is {room_name}')
         return JSONResponse(status_code=450, content="Room does not exist")
     if users.get(from_alias) is None:
         LOGGER.debug(f'In POST MESSAGE - ALIAS does not exist: {message} == alias is {from_alias}')
         return JSONResponse(status_code=455, content=f'alias {from_alias} does not exist')
-    if from_alias not in room_instance.member_list:
+    if not room_instance.is_member(from_alias):
         LOGGER.debug(f'In POST MESSAGE - ALIAS is not in ROOM: {message} == alias is {from_alias} == room is {room_name}')
         return JSONResponse(status_code=445, content=f'alias {from_alias} is not a member of room {room_name}')
-    if room_instance.send_message(message=message, from_alias=from_alias) is True:
+    if await IO_EXECUTOR.run(room_instance.send_message, message=message, from_alias=from_alias) is True:
         LOGGER.debug(f'In POST MESSAGE - SUCCESS: {message} == room is {room_name}')
         return "Success"    
     else:
         LOGGER.debug(f'In POST MESSAGE - PROBLEMS: {message} == room is {room_name}')
         return JSONResponse(status_code=410, content="Problems")
 
+@app.post("/messages/batch", status_code=200, response_model=list[BatchMessageResult])
+async def send_message_batch(request: Request, batch: list[BatchMessage]):
+    """send many messages, to one or more rooms, in one call
+
+    Args:
+        batch (list): messages in send order, each with room_name, message, from_alias (and to_alias)
+
+    Returns:
+        list: one result per message in the same order, with the status code POST /message would have answered
+            (201, 450, 455, 445 or 410) and the sequence number of each message that was added
+    """
+    LOGGER.info(f"starting POST MESSAGE BATCH of {len(batch)} messages")
+    if len(batch) > MESSAGE_BATCH_MAX:
+        LOGGER.debug(f'In POST MESSAGE BATCH - TOO LARGE: {len(batch)} messages')
+        return JSONResponse(status_code=413, content=f'a batch can have at most {MESSAGE_BATCH_MAX} messages')
+    results = [None] * len(batch)
+    checked = dict()
+    by_room = dict()
+    for index, item in enumerate(batch):
+        if (problem := checked.get((item.room_name, item.from_alias))) is None:
+            if (room_instance := await get_loaded_room(item.room_name)) is None:
+                problem = (450, f'Room {item.room_name} does not exist')
+            elif users.get(item.from_alias) is None:
+                problem = (455, f'alias {item.from_alias} does not exist')
+            elif not room_instance.is_member(item.from_alias):
+                problem = (445, f'alias {item.from_alias} is not a member of room {item.room_name}')
+            else:
+                problem = (201, '')
+            checked[(item.room_name, item.from_alias)] = problem
+        if problem[0] != 201:
+            results[index] = BatchMessageResult(index=index, status_code=problem[0], detail=problem[1])
+        else:
+            by_room.setdefault(item.room_name, []).append(index)
+
+    async def send_to_room(room_name: str, indexes: list):
+        room_instance = room_list.get(room_name=room_name)
+        sent = await IO_EXECUTOR.run(room_instance.send_messages, [(batch[index].message, batch[index].from_alias) for index in indexes])
+        for index, message_object in zip(indexes, sent):
+            if message_object is None:
+                results[index] = BatchMessageResult(index=index, status_code=410, detail='Problems')
+            else:
+                results[index] = BatchMessageResult(index=index, status_code=201, detail='Success', sequence_num=message_object.sequence_num)
+
+    await asyncio.gather(*[send_to_room(room_name, indexes) for room_name, indexes in by_room.items()])
+    LOGGER.debug(f'In POST MESSAGE BATCH - {len(batch)} messages for {len(by_room)} rooms')
+    LOGGER.info("End POST MESSAGE BATCH")
+    return results
+
 @app.get("/room/members", status_code=200)
 async def get_room_members(request: Request, alias: str, room_name: str, messages_to_get: int = -1):
     """ Docstring
     """
     LOGGER.info("starting GET ROOM MEMBERS")
-    if (room_instance := room_list.get(room_name=room_name)) is None:
+    if (room_instance := await get_loaded_room(room_name)) is None:
         LOGGER.debug(f'in ROOM MEMBERS - ROOM DOES NOT EXIST: {room_name}')
         return JSONResponse(status_code=450, content=f"Room {room_name} does not exist")
     if users.get(alias) is None:
         LOGGER.debug(f'in ROOM MEMBERS - ALIAS DOES NOT EXIST: {alias}')
         return JSONResponse(status_code=455, content=f'alias {alias} does not exist')
-    if alias not in room_instance.member_list:
+    if not room_instance.is_member(alias):
         LOGGER.debug(f'in ROOM MEMBERS - ALIAS: {alias} is not part of ROOM: {room_name}')
         return JSONResponse(status_code=445, content=f'alias {alias} is not a member of room {room_name}')
-    messages, message_objects, total_mess = room_instance.get_messages(user_alias=alias, num_messages=messages_to_get, return_objects=True)
+    messages, message_objects, total_mess = await IO_EXECUTOR.run(room_instance.get_messages, user_alias=alias, num_messages=messages_to_get, return_objects=True)
     LOGGER.debug(f'in GET MESSAGES - after getting messages for room: {room_name}\n messages are {messages}')
     for message in message_objects:
         LOGGER.debug(f'GET MESSAGES - Message: {message.message} == message props: {message.mess_props} host is {request.client.host}')
@@ -226,18 +480,31 @@ async def get_users(request: Request):
         return JSONResponse(status_code=405, content="No users have been registered")
 
 
+@app.get("/users/{alias}/rooms", status_code=200)
+async def get_user_rooms(request: Request, alias: str):
+    """ API for listing the rooms a user is a member of
+    """
+    if users.get(alias) is None:
+        LOGGER.debug(f'In GET USER ROOMS - ALIAS DOES NOT EXIST: {alias}')
+        return JSONResponse(status_code=455, content=f'alias {alias} does not exist')
+    room_names = [room.room_name for room in room_list.find_by_member(alias)]
+    LOGGER.debug(f'In GET USER ROOMS - SUCCESS: {alias} is in {room_names}')
+    return room_names
+
+
 @app.post("/users/alias", status_code=201)
-async def register_client(request: Request, alias: str):
-    """ API for adding a user alias
+async def register_client(request: Request, alias: str, password: str | None = Form(None)):
+    """ API for adding a user alias, with an optional password for logging in through /token
     """
-    users.register(alias)
+    hash_pass = await HASH_EXECUTOR.run(get_password_hash, password) if password else ""
+    await IO_EXECUTOR.run(users.register, alias, hash_pass)
 
 @app.post("/users/remove_alias", status_code=201)
 async def deregister_client(request: Request, client_alias: str):
     """ Docstring
     """
     if users.get(client_alias) is not None:
-        users.deregister(client_alias)
+        await IO_EXECUTOR.run(users.deregister, client_alias)
         LOGGER.debug(f'In POST REMOVE ALIAS - SUCCESS: {client_alias}')
         return "success"
     else:
@@ -248,11 +515,33 @@ async def deregister_client(request: Request, client_alias: str):
 async def create_room(request: Request, room_name: str, owner_alias: str, room_type: int = ROOM_TYPE_PUBLIC):
     """ API for creating a room
     """
-    chat_room = ChatRoom(room_name, [], owner_alias, room_type, True)
-    room_list.add(chat_room)
+    chat_room = await IO_EXECUTOR.run(ChatRoom, room_name, [], owner_alias, room_type, True, user_list=users)
+    await IO_EXECUTOR.run(room_list.add, chat_room)
     return
 
 
+@app.get("/stats/mongo_pool", status_code=200)
+async def get_mongo_pool_stats(request: Request):
+    """ API for checking the shared mongo connection pool
+    """
+    return {'options': MONGO_CLIENTS.pool_options, 'pools': MONGO_CLIENTS.pool_stats()}
+
+
+@app.on_event("shutdown")
+def shutdown():
+    """ finish the storage calls in flight, write out any queued messages and close the shared mongo clients when the server stops
+    """
+    HASH_EXECUTOR.shutdown()
+    IO_EXECUTOR.shutdown()
+    WRITE_BEHIND.stop()
+    for room in room_list.room_list:
+        try:
+            room.persist()  # anything the write-behind flusher handed back to its room
+        except Exception as problem:
+            LOGGER.error(f'Could not persist room {room.room_name} on shutdown: {problem}')
+    MONGO_CLIENTS.close_all()
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, filename="chat.log")
 
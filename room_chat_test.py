@@ -8,6 +8,7 @@
 import json
 import requests
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from constants import *
 from users import *
 import pprint as pp
@@ -181,6 +182,67 @@ class TestChatRoomAPI(unittest.TestCase):
         message_list = json.loads(response2.content)
         self.assertIn(TEST_MESSAGE_NUMBERS, message_list)
 
+    def test_get_messages_after_seq(self):
+        """ fetch the high water mark, send one message and check that only the new message comes back after it
+        """
+        LOGGER.debug("entering test_get_messages_after_seq")
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&messages_to_get=1')
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        last_seq = int(response.headers['X-Last-Sequence-Num'])
+        response = requests.post(f'http://localhost:8000/message?room_name={PUBLIC_ROOM_NAME}&message={TEST_MESSAGE_SHORT}&from_alias={USER_ALIAS}&to_alias={USER_ALIAS}')
+        self.assertEqual(response.status_code, CREATED_RESPONSE_CODE)
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&after_seq={last_seq}')
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        self.assertEqual(json.loads(response.content), [TEST_MESSAGE_SHORT])
+        self.assertGreater(int(response.headers['X-Last-Sequence-Num']), last_seq)
+
+    def test_get_messages_not_modified(self):
+        """ repeating a GET with the ETag of the last response gets a 304 until the room changes
+        """
+        LOGGER.debug("entering test_get_messages_not_modified")
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&messages_to_get=10')
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        etag = response.headers['ETag']
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&messages_to_get=10', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = requests.post(f'http://localhost:8000/message?room_name={PUBLIC_ROOM_NAME}&message={TEST_MESSAGE_SHORT}&from_alias={USER_ALIAS}&to_alias={USER_ALIAS}')
+        self.assertEqual(response.status_code, CREATED_RESPONSE_CODE)
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&messages_to_get=10', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_send_message_batch(self):
+        """ a batch gets one result per message, in order, with the same status codes as single sends
+        """
+        LOGGER.debug("entering test_send_message_batch")
+        batch = [{'room_name': PUBLIC_ROOM_NAME, 'message': f'{TEST_MESSAGE} {loop_control}', 'from_alias': USER_ALIAS} for loop_control in range(0, NUM_MESSAGES)]
+        batch.append({'room_name': 'no such room', 'message': TEST_MESSAGE, 'from_alias': USER_ALIAS})
+        response = requests.post(f'http://localhost:8000/messages/batch', json=batch)
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        results = json.loads(response.content)
+        self.assertEqual([result['status_code'] for result in results], [CREATED_RESPONSE_CODE] * NUM_MESSAGES + [450])
+        sequence_nums = [result['sequence_num'] for result in results[:NUM_MESSAGES]]
+        self.assertEqual(sequence_nums, list(range(sequence_nums[0], sequence_nums[0] + NUM_MESSAGES)))
+
+    def test_long_poll_messages(self):
+        """ a long poll with nothing new waits for the next message instead of the client polling in a loop
+        """
+        LOGGER.debug("entering test_long_poll_messages")
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&messages_to_get=1')
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        last_seq = int(response.headers['X-Last-Sequence-Num'])
+        response = requests.get(f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&after_seq={last_seq}&wait=1')
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        self.assertEqual(json.loads(response.content), [])
+        poller = ThreadPoolExecutor(max_workers=1)
+        long_poll = poller.submit(requests.get, f'http://localhost:8000/messages?alias={USER_ALIAS}&room_name={PUBLIC_ROOM_NAME}&after_seq={last_seq}&wait=10')
+        response = requests.post(f'http://localhost:8000/message?room_name={PUBLIC_ROOM_NAME}&message={TEST_MESSAGE_SHORT}&from_alias={USER_ALIAS}&to_alias={USER_ALIAS}')
+        self.assertEqual(response.status_code, CREATED_RESPONSE_CODE)
+        response = long_poll.result(timeout=15)
+        poller.shutdown()
+        self.assertEqual(response.status_code, OK_RESPONSE_CODE)
+        self.assertEqual(json.loads(response.content), [TEST_MESSAGE_SHORT])
+
     def test_get_users(self):
         """testing the api get call to /users
         """
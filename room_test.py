@@ -5,10 +5,16 @@
 
     tests for Room Chat implementation
 """
+import asyncio
+import json
 import pprint as pp
+import threading
 import unittest
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from itertools import repeat
 
+import columnar
 from constants import *
 from room import *
 
@@ -26,8 +32,8 @@ class Test_ChatRoom(unittest.TestCase):
             Set up a ChatRoom instance for both public and private rooms
         """
         logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, filename="room_test.log")
-        self.room_list = RoomList(DEFAULT_ROOM_LIST_NAME)
-        self.users = UserList(DEFAULT_USER_LIST_NAME)
+        self.users = shared_user_list(DEFAULT_USER_LIST_NAME)
+        self.room_list = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users)
         self.room_public = self.room_list.get(PUBLIC_ROOM_NAME)
         if self.room_public is None:
             self.room_public = self.room_list.create(room_name=PUBLIC_ROOM_NAME, owner_alias=USER_ALIAS, member_list=[USER_ALIAS, 'eshner'], room_type=ROOM_TYPE_PUBLIC)
@@ -37,7 +43,28 @@ class Test_ChatRoom(unittest.TestCase):
             self.room_private = self.room_list.create(room_name=PRIVATE_ROOM_NAME, owner_alias=USER_ALIAS, member_list=[USER_ALIAS, 'eshner'], room_type=ROOM_TYPE_PRIVATE)
         self.__last_private_message_sent: str = ''
         self.__last_public_message_sent: str = '' 
+        self.scratch_rooms = []
+        self.scratch_lists = []
         self.stats_client.incr('room_test_count')
+
+    def tearDown(self):
+        """ drop what tests made under throwaway names: the rooms' collections and sequence documents, and room lists
+        """
+        mongo_db = MONGO_CLIENTS.get_client().cpsc313
+        for room in self.scratch_rooms:
+            room.flush()
+        for room_name in {room.room_name for room in self.scratch_rooms}:
+            mongo_db.drop_collection(room_name)
+            mongo_db.get_collection('sequence').delete_one({'_id': room_name})
+        for list_name in self.scratch_lists:
+            MONGO_CLIENTS.get_client()[MONGO_DB_NAME][DEFAULT_ROOM_LIST_NAME].delete_one({'list_name': list_name})
+
+    def scratch_room(self, room_name: str, **kwargs) -> ChatRoom:
+        """ a new public room that tearDown drops again
+        """
+        room = ChatRoom(room_name, [], USER_ALIAS, ROOM_TYPE_PUBLIC, True, user_list=self.users, **kwargs)
+        self.scratch_rooms.append(room)
+        return room
         
 
     def test_get_messages(self):
@@ -162,6 +189,323 @@ class Test_ChatRoom(unittest.TestCase):
         LOGGER.debug(pp.pformat(message_list))
         self.assertIn(TEST_MESSAGE_NUMBERS, message_list)
 
+    def test_shared_user_directory(self):
+        """ the room list and the test use the same user directory, so users registered here are seen by the rooms
+        """
+        self.assertIs(self.room_list.user_list, shared_user_list(DEFAULT_USER_LIST_NAME))
+        if self.users.get('testing') is None:
+            self.users.register('testing')
+        self.room_public.add_member('testing')
+        self.assertIn('testing', self.room_public.member_list)
+
+    def test_write_behind_send(self):
+        """ send through a write-behind room and check the message is in mongo after flush
+        """
+        LOGGER.debug("entering test_write_behind_send")
+        room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, ROOM_TYPE_PUBLIC, False, user_list=self.users, write_behind=True)
+        self.assertTrue(room.send_message(TEST_MESSAGE, USER_ALIAS))
+        room.flush()
+        message = room[-1]
+        self.assertFalse(message.dirty)
+        self.assertIsNotNone(message.mess_id)
+        self.assertGreater(message.sequence_num, 0)
+
+    def test_write_behind_failure(self):
+        """ flush returns while writes keep failing, and the message handed back to the room is written once mongo works again
+        """
+        room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, ROOM_TYPE_PUBLIC, False, user_list=self.users, write_behind=True)
+
+        def unavailable(messages):
+            raise ConnectionError('mongo is down')
+        room.persist_batch = unavailable
+        self.assertTrue(room.send_message(TEST_MESSAGE, USER_ALIAS))
+        message = room[-1]
+        WRITE_BEHIND.flush()
+        self.assertTrue(message.dirty)
+        del room.persist_batch
+        room.flush()
+        self.assertFalse(message.dirty)
+
+    def test_sequence_numbers_increase(self):
+        """ two sends in a row get increasing sequence numbers from the room's lease
+        """
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE, USER_ALIAS))
+        first = self.room_public[-1].sequence_num
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE2, USER_ALIAS))
+        second = self.room_public[-1].sequence_num
+        self.assertGreater(second, first)
+
+    def test_send_messages(self):
+        """ a batch of messages gets a contiguous range of sequence numbers
+        """
+        sent = self.room_public.send_messages([(TEST_MESSAGE, USER_ALIAS), (TEST_MESSAGE2, USER_ALIAS), (TEST_MESSAGE_SHORT, USER_ALIAS)])
+        self.assertNotIn(None, sent)
+        self.assertEqual([message.sequence_num - sent[0].sequence_num for message in sent], [0, 1, 2])
+        self.assertIs(self.room_public.get(), sent[-1])
+        self.assertTrue(all(message.mess_id is not None for message in sent))
+
+    def test_persist_batch_retry(self):
+        """ retrying a batch whose first attempt wrote part of it does not insert those messages again
+        """
+        messages = [ChatMessage(text, None, MessageProperties(PUBLIC_ROOM_NAME, MESSAGE_TYPE_SENT, PUBLIC_ROOM_NAME, USER_ALIAS, datetime.now(), None))
+                    for text in (TEST_MESSAGE, TEST_MESSAGE2)]
+        messages[0].mess_id = ObjectId()
+        collection = MONGO_CLIENTS.get_client().cpsc313.get_collection(PUBLIC_ROOM_NAME)
+        collection.insert_one(dict(messages[0].to_dict(), _id=messages[0].mess_id))
+        self.room_public.persist_batch(messages)
+        self.assertFalse(any(message.dirty for message in messages))
+        self.assertEqual(collection.count_documents({'_id': {'$in': [message.mess_id for message in messages]}}), 2)
+
+    def test_message_json_cache(self):
+        """ a message put in the room carries its encoded JSON, and the full form follows a new sequence number
+        """
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE_SHORT, USER_ALIAS))
+        message = self.room_public.get()
+        self.assertEqual(json.loads(message.json_bytes), TEST_MESSAGE_SHORT)
+        self.assertEqual(json.loads(message.full_json_bytes)['sequence_num'], message.sequence_num)
+        message.sequence_num = message.sequence_num + 1
+        self.assertEqual(json.loads(message.full_json_bytes)['sequence_num'], message.sequence_num)
+
+    def test_lazy_room_restore(self):
+        """ a restored room list creates its rooms without loading messages until they are used
+        """
+        room_list = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users)
+        room = room_list.get(PUBLIC_ROOM_NAME)
+        self.assertIsNotNone(room)
+        self.assertFalse(room.loaded)
+        room.get_messages(USER_ALIAS, 5)
+        self.assertTrue(room.loaded)
+
+    def test_lazy_room_member_change(self):
+        """ a member added before a lazy room has loaded is still a member once it loads, and is persisted
+        """
+        if self.users.get('alice') is None:
+            self.users.register('alice')
+        self.room_public.remove_group_member('alice')
+        self.room_public.persist()
+        room_list = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users)
+        room = room_list.get(PUBLIC_ROOM_NAME)
+        room.add_member('alice')
+        room.get_messages(USER_ALIAS, 5)
+        self.assertTrue(room.is_member('alice'))
+        self.assertIn(PUBLIC_ROOM_NAME, [member_room.room_name for member_room in room_list.find_by_member('alice')])
+        room.persist()
+        restored = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users).get(PUBLIC_ROOM_NAME)
+        restored.ensure_loaded()
+        self.assertTrue(restored.is_member('alice'))
+
+    def test_membership_after_restart(self):
+        """ a member added or removed before a restart is seen the same way by the restored lazy room
+        """
+        for alias in ('bob', 'carl'):
+            if self.users.get(alias) is None:
+                self.users.register(alias)
+        self.room_public.add_member('bob')
+        self.room_public.add_member('carl')
+        self.room_public.persist()
+        room = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users).get(PUBLIC_ROOM_NAME)
+        room.remove_group_member('bob')
+        room.persist()
+        restarted = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users).get(PUBLIC_ROOM_NAME)
+        self.assertTrue(restarted.is_member('carl'))
+        self.assertFalse(restarted.is_member('bob'))
+
+    def test_room_list_members_after_restart(self):
+        """ a member who joins or leaves is in the room list metadata a restart restores from, without persisting the list
+        """
+        if self.users.get('dave') is None:
+            self.users.register('dave')
+        self.room_public.add_member('dave')
+        restarted = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users)
+        self.assertIn(PUBLIC_ROOM_NAME, [room.room_name for room in restarted.find_by_member('dave')])
+        self.assertIn('dave', restarted.find_room_in_metadata(PUBLIC_ROOM_NAME)['member_list'])
+        self.room_public.remove_group_member('dave')
+        restarted = RoomList(DEFAULT_ROOM_LIST_NAME, user_list=self.users)
+        self.assertNotIn(PUBLIC_ROOM_NAME, [room.room_name for room in restarted.find_by_member('dave')])
+
+    def test_hot_window(self):
+        """ a room keeps at most hot_window messages in memory and pages older ones from mongo
+        """
+        room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, ROOM_TYPE_PUBLIC, False, user_list=self.users, hot_window=5)
+        for loop_control in range(0, 10):
+            self.assertTrue(room.send_message(TEST_MESSAGE, USER_ALIAS))
+        self.assertLessEqual(len(room), 5)
+        message_list, message_objects, num_messages = room.get_messages(USER_ALIAS, 8, True)
+        self.assertEqual(num_messages, 8)
+        self.assertEqual(room.window_stats['misses'], 1)
+
+    def test_whole_history(self):
+        """ asking for every message (the default -1) returns the history older than the window too
+        """
+        room = self.scratch_room(f'history_{uuid.uuid4().hex}', hot_window=3)
+        room.send_messages([(f'{TEST_MESSAGE} {index}', USER_ALIAS) for index in range(10)])
+        message_list, message_objects, num_messages = room.get_messages(USER_ALIAS)
+        self.assertEqual(message_list, [f'{TEST_MESSAGE} {index}' for index in reversed(range(10))])
+
+    def test_state_with_messages(self):
+        """ the state returned with the messages is the room's high water mark at the time of the read
+        """
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE, USER_ALIAS))
+        message_list, message_objects, num_messages, state = self.room_public.get_messages(USER_ALIAS, 5, True, return_state=True)
+        self.assertEqual(state, self.room_public.state)
+        self.assertEqual(state[0], message_objects[0].sequence_num)
+
+    def test_find_by_sequence_num(self):
+        """ a sent message can be found again by its sequence number, and by a range around it
+        """
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE, USER_ALIAS))
+        sequence_num = self.room_public.last_sequence_num
+        message = self.room_public.find_by_sequence_num(sequence_num)
+        self.assertIsNotNone(message)
+        self.assertEqual(message.message, TEST_MESSAGE)
+        self.assertIn(message, self.room_public.find_by_sequence_range(sequence_num - 1, sequence_num))
+        self.assertIsNone(self.room_public.find_by_sequence_num(sequence_num + 1))
+
+    def test_blacklist_filtering(self):
+        """ messages from a blacklisted sender are hidden, and shown again once they are taken off the blacklist
+        """
+        if self.users.get('eshner') is None:
+            self.users.register('eshner')
+        self.room_public.add_member('eshner')
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE_SHORT, 'eshner'))
+        user = self.users.get(USER_ALIAS)
+        user.add_alias_to_blacklist('eshner')
+        message_list, message_objects, num_messages = self.room_public.get_messages(USER_ALIAS, 1000, True)
+        self.assertNotIn('eshner', [message.mess_props.from_user for message in message_objects])
+        user.remove_alias_from_blacklist('eshner')
+        message_list, message_objects, num_messages = self.room_public.get_messages(USER_ALIAS, 1000, True)
+        self.assertIn('eshner', [message.mess_props.from_user for message in message_objects])
+
+    def test_search_messages(self):
+        """ every term has to match, a trailing * matches by prefix and the newest match comes first
+        """
+        self.assertTrue(self.room_public.send_message('deploy moved to friday', USER_ALIAS))
+        self.assertTrue(self.room_public.send_message('friday deploy is done', USER_ALIAS))
+        results = self.room_public.search_messages(USER_ALIAS, 'deploy fri*')
+        self.assertGreaterEqual(len(results), 2)
+        self.assertEqual(results[0].message, 'friday deploy is done')
+        self.assertEqual(self.room_public.search_messages(USER_ALIAS, 'deploy xyzzy'), [])
+        self.assertEqual(self.room_public.find_message('deploy moved to friday').message, 'deploy moved to friday')
+
+    def test_search_older_than_window(self):
+        """ search finds matches that fell out of the in memory window, unless it is limited to the window
+        """
+        token = f'needle{uuid.uuid4().hex}'
+        room = self.scratch_room(f'search_{token}', hot_window=5)
+        room.send_messages([(f'{token} number {index}', USER_ALIAS) for index in range(12)])
+        room.send_messages([(TEST_MESSAGE, USER_ALIAS)] * 3)
+        room.flush()
+        collection = MONGO_CLIENTS.get_client().cpsc313.get_collection(room.room_name)
+        self.assertEqual(collection.find_one({'message': f'{token} number 1'})['tokens'], sorted([token, 'number', '1']))
+        # written before messages carried their tokens, found once the first history search adds them
+        collection.update_one({'message': f'{token} number 0'}, {'$unset': {'tokens': ''}})
+        results = room.search_messages(USER_ALIAS, token, limit=0)
+        self.assertEqual([message.message for message in results], [f'{token} number {index}' for index in reversed(range(12))])
+        self.assertEqual(len(room.search_messages(USER_ALIAS, token, limit=0, include_history=False)), 2)
+        self.assertEqual(len(room.search_messages(USER_ALIAS, f'{token} numb*', limit=4)), 4)
+        self.assertIsNotNone(room.find_message(f'{token} number 0'))
+
+    def test_remove_messages_by_user(self):
+        """ removing a sender's messages flags them in memory and in mongo
+        """
+        if self.users.get('eshner') is None:
+            self.users.register('eshner')
+        self.room_public.add_member('eshner')
+        self.assertTrue(self.room_public.send_message(TEST_MESSAGE_SHORT, 'eshner'))
+        self.assertGreater(len(self.room_public.find_messages_by_user('eshner')), 0)
+        removed = self.room_public.remove_messages_by_user('eshner')
+        self.assertTrue(all(message.removed for message in removed))
+        self.assertEqual(self.room_public.find_messages_by_user('eshner'), [])
+        restored_room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, ROOM_TYPE_PUBLIC, False, user_list=self.users)
+        self.assertEqual(restored_room.find_messages_by_user('eshner'), [])
+
+    @unittest.skipIf(columnar.np is None, 'numpy is not installed')
+    def test_columnar_matches_deque(self):
+        """ a columnar room returns the same messages as a plain one
+        """
+        plain_room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, ROOM_TYPE_PUBLIC, False, user_list=self.users)
+        columnar_room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, ROOM_TYPE_PUBLIC, False, user_list=self.users, columnar=True)
+        self.assertEqual(plain_room.get_messages(USER_ALIAS, 20)[0], columnar_room.get_messages(USER_ALIAS, 20)[0])
+        self.assertEqual(len(plain_room.find_messages_by_time()), len(columnar_room.find_messages_by_time()))
+
+    def test_stream_subscription(self):
+        """ a message sent to the room reaches a subscriber of the room's topic
+        """
+        async def send_and_receive():
+            subscription = MESSAGE_BROKER.subscribe(PUBLIC_ROOM_NAME)
+            try:
+                self.assertTrue(self.room_public.send_message(TEST_MESSAGE_SHORT, USER_ALIAS))
+                return await subscription.get(timeout=5)
+            finally:
+                MESSAGE_BROKER.unsubscribe(subscription)
+        message = asyncio.run(send_and_receive())
+        self.assertIsNotNone(message)
+        self.assertEqual(message.message, TEST_MESSAGE_SHORT)
+
+    def test_find_by_member(self):
+        """ the member index follows members joining and leaving a room
+        """
+        if self.users.get('eshner') is None:
+            self.users.register('eshner')
+        self.room_public.add_member('eshner')
+        self.assertTrue(self.room_public.is_member('eshner'))
+        self.assertIn(PUBLIC_ROOM_NAME, [room.room_name for room in self.room_list.find_by_member('eshner')])
+        self.room_public.remove_group_member('eshner')
+        self.assertFalse(self.room_public.is_member('eshner'))
+        self.assertNotIn(PUBLIC_ROOM_NAME, [room.room_name for room in self.room_list.find_by_member('eshner')])
+
+    def test_deregister_leaves_rooms(self):
+        """ the room list passes a deregistration on to the rooms the user is a member of
+        """
+        if self.users.get('leaving') is None:
+            self.users.register('leaving')
+        self.room_public.add_member('leaving')
+        self.users.deregister('leaving')
+        self.assertFalse(self.room_public.is_member('leaving'))
+        self.assertEqual(self.room_list.find_by_member('leaving'), [])
+
+    def test_concurrent_readers(self):
+        """ reads running on other threads while messages are sent and evicted neither fail nor see a half updated window
+        """
+        room = self.scratch_room(f'concurrent_{uuid.uuid4().hex}', hot_window=20)
+        done = threading.Event()
+
+        def send():
+            for index in range(500):
+                room.send_message(f'concurrent message {index}', USER_ALIAS)
+
+        def read(reader):
+            while not done.is_set():
+                reader()
+
+        readers = [lambda: room.get_messages(USER_ALIAS, 15),
+                   lambda: room.get_messages(USER_ALIAS, 30),
+                   lambda: room.get_messages_since(USER_ALIAS, room.last_sequence_num - 10),
+                   lambda: room.find_by_sequence_range(0, room.last_sequence_num),
+                   lambda: room.search_messages(USER_ALIAS, 'concurrent', include_history=False),
+                   lambda: room.find_messages_by_user(USER_ALIAS)]
+        with ThreadPoolExecutor(max_workers=len(readers) + 1) as pool:
+            reads = [pool.submit(read, reader) for reader in readers]
+            try:
+                pool.submit(send).result()
+            finally:
+                done.set()
+            for future in reads:
+                future.result()
+        self.assertEqual(len(room), 20)
+
+    def test_concurrent_room_list_add(self):
+        """ of several rooms with the same name added at once, exactly one ends up in the list
+        """
+        room_name = f'concurrent_{uuid.uuid4().hex}'
+        room_list = RoomList(room_name, user_list=self.users)
+        self.scratch_lists.append(room_list.name)
+        rooms = [self.scratch_room(room_name) for _ in range(8)]
+        with ThreadPoolExecutor(max_workers=len(rooms)) as pool:
+            added = list(pool.map(room_list.add, rooms))
+        self.assertEqual(added.count(True), 1)
+        self.assertEqual(len([room for room in room_list.room_list if room.room_name == room_name]), 1)
+
     def test_room_list_add(self):
         chat_room = ChatRoom(PUBLIC_ROOM_NAME, [], USER_ALIAS, USER_ALIAS, True)
         self.room_list.add(chat_room)
@@ -0,0 +1,135 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    inverted token index for searching the messages of a room
+"""
+import bisect
+import re
+from collections import deque
+
+from constants import *
+
+LOGGER = logging.getLogger(__name__)
+
+SEARCH_DEFAULT_LIMIT = 50
+TOKEN_PATTERN = re.compile(r'\w+')
+PREFIX_MARKER = '*'
+
+
+def tokenize(text: str) -> list:
+    """ split message text into lower case word tokens
+    """
+    if not isinstance(text, str):
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_query(query: str) -> list:
+    """ turn a query into (token, is_prefix) terms. A term ending in * matches every token starting with it
+
+    Args:
+        query (str): space separated terms, e.g. 'deploy fri*'
+
+    Returns:
+        list: (token, is_prefix) tuples, all of which must match
+    """
+    terms = []
+    for raw_term in query.split():
+        tokens = tokenize(raw_term)
+        for position, token in enumerate(tokens):
+            terms.append((token, raw_term.endswith(PREFIX_MARKER) and position == len(tokens) - 1))
+    return terms
+
+
+def matches(terms: list, text: str) -> bool:
+    """ check one message against parsed query terms the way the index does, used for messages outside the index
+
+    Args:
+        terms (list): (token, is_prefix) tuples from parse_query
+        text (str): message text
+
+    Returns:
+        bool: True if every term matches a word of the text
+    """
+    tokens = set(tokenize(text))
+    for token, is_prefix in terms:
+        if not (any(word.startswith(token) for word in tokens) if is_prefix else token in tokens):
+            return False
+    return True
+
+
+class MessageSearchIndex():
+    """ Inverted index from token to the sequence numbers of the messages containing it, kept by a ChatRoom for
+        the messages in its window. Postings are deques in put order so evicting the oldest message is a popleft.
+        A sorted vocabulary supports prefix terms
+    """
+
+    def __init__(self) -> None:
+        self.__postings = dict()
+        self.__vocabulary = []
+
+    def __len__(self):
+        return len(self.__postings)
+
+    def add(self, message) -> None:
+        """index a message that has a sequence number
+        """
+        sequence_num = message.sequence_num
+        if sequence_num < 0:
+            return
+        for token in set(tokenize(message.message)):
+            if (posting := self.__postings.get(token)) is None:
+                posting = self.__postings[token] = deque()
+                bisect.insort(self.__vocabulary, token)
+            if len(posting) == 0 or posting[-1] < sequence_num:
+                posting.append(sequence_num)
+            elif sequence_num not in posting:
+                posting.append(sequence_num)
+                self.__postings[token] = deque(sorted(posting))
+
+    def discard(self, message) -> None:
+        """remove a message, normally the oldest one as it is evicted from the window
+        """
+        sequence_num = message.sequence_num
+        for token in set(tokenize(message.message)):
+            if (posting := self.__postings.get(token)) is None:
+                continue
+            if len(posting) > 0 and posting[0] == sequence_num:
+                posting.popleft()
+            elif sequence_num in posting:
+                posting.remove(sequence_num)
+            if len(posting) == 0:
+                del self.__postings[token]
+                del self.__vocabulary[bisect.bisect_left(self.__vocabulary, token)]
+
+    def __matching(self, token: str, is_prefix: bool) -> set:
+        if not is_prefix:
+            return set(self.__postings.get(token, ()))
+        matches = set()
+        position = bisect.bisect_left(self.__vocabulary, token)
+        while position < len(self.__vocabulary) and self.__vocabulary[position].startswith(token):
+            matches.update(self.__postings[self.__vocabulary[position]])
+            position += 1
+        return matches
+
+    def search(self, query: str) -> list:
+        """sequence numbers of the messages matching every term of the query, newest first
+
+        Args:
+            query (str): space separated terms, a trailing * makes a term a prefix
+
+        Returns:
+            list: matching sequence numbers in descending order
+        """
+        terms = parse_query(query)
+        if len(terms) == 0:
+            return []
+        candidate_sets = sorted((self.__matching(token, is_prefix) for token, is_prefix in terms), key=len)
+        matches = candidate_sets[0]
+        for candidates in candidate_sets[1:]:
+            if len(matches) == 0:
+                break
+            matches = matches & candidates
+        return sorted(matches, reverse=True)
@@ -0,0 +1,87 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    leased blocks of message sequence numbers, one sequence document per room
+"""
+import threading
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from constants import *
+
+LOGGER = logging.getLogger(__name__)
+
+SEQUENCE_LEASE_SIZE = 1000
+LEGACY_SEQUENCE_ID = 'userid'
+
+
+class SequenceLease():
+    """ Hands out sequence numbers for one room from blocks leased from the room's own document in the
+        sequence collection ({'_id': room_name, 'last_leased': n}). Each lease is one $inc, so every process
+        gets a block no other process (or later restart) will ever be given. Numbers left in a block when the
+        process stops are never used, so there can be gaps
+    """
+
+    def __init__(self, collection, room_name: str, lease_size: int = SEQUENCE_LEASE_SIZE) -> None:
+        self.__collection = collection
+        self.__room_name = room_name
+        self.__lease_size = lease_size
+        self.__next = 0
+        self.__last = -1
+        self.__lock = threading.Lock()
+
+    @property
+    def last_issued(self) -> int:
+        """the last number handed out by this process, -1 if none yet
+        """
+        return self.__next - 1 if self.__last >= 0 else -1
+
+    def next(self) -> int:
+        return self.allocate(1)
+
+    def allocate(self, count: int = 1) -> int:
+        """reserve count contiguous sequence numbers
+
+        Args:
+            count (int): how many numbers are needed
+
+        Returns:
+            int: the first number of the range, the range is first .. first + count - 1
+        """
+        with self.__lock:
+            if self.__last - self.__next + 1 < count:
+                self.__lease(max(count, self.__lease_size))
+            first = self.__next
+            self.__next += count
+            return first
+
+    def __lease(self, size: int) -> None:
+        lease = self.__collection.find_one_and_update(
+            {'_id': self.__room_name},
+            {'$inc': {'last_leased': size}},
+            projection={'last_leased': True, '_id': False},
+            return_document=ReturnDocument.AFTER)
+        if lease is None:
+            self.__seed()
+            lease = self.__collection.find_one_and_update(
+                {'_id': self.__room_name},
+                {'$inc': {'last_leased': size}},
+                projection={'last_leased': True, '_id': False},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+        self.__last = lease['last_leased']
+        self.__next = self.__last - size + 1
+        LOGGER.debug(f'Leased sequence numbers {self.__next} - {self.__last} for {self.__room_name}')
+
+    def __seed(self) -> None:
+        """ first lease for a room: start after the value in the old shared counter document so numbers keep increasing
+        """
+        legacy = self.__collection.find_one({'_id': LEGACY_SEQUENCE_ID}, projection={self.__room_name: True})
+        start = legacy.get(self.__room_name, 0) if legacy is not None else 0
+        try:
+            self.__collection.update_one({'_id': self.__room_name}, {'$max': {'last_leased': start}}, upsert=True)
+        except DuplicateKeyError:
+            pass  # another process seeded it first
@@ -6,27 +6,39 @@
     ChatUser implementation
 """
 
+import inspect
 import queue
+import threading
+import weakref
 from constants import *
 from datetime import date, datetime
-from pymongo import MongoClient
 from constants import *
+from mongo_pool import MONGO_CLIENTS
 
 LOGGER = logging.getLogger(__name__)
 
+USER_EVENT_REGISTER = 'register'
+USER_EVENT_DEREGISTER = 'deregister'
+USER_EVENT_BLACKLIST = 'blacklist'
+USER_EVENT_ALIAS = 'alias'
+
 class ChatUser():
     """ class for users of the chat system. Users must be registered 
     """
 
-    def __init__(self, alias: str, password: str = "", user_id = None, email: str = "", blacklist: list = [], create_time: datetime = datetime.now(), modify_time: datetime = datetime.now()) -> None:
+    def __init__(self, alias: str, password: str = "", user_id = None, email: str = "", blacklist: list = None, create_time: datetime = datetime.now(), modify_time: datetime = datetime.now()) -> None:
         self.__alias = alias
         self.__user_id = user_id 
         self.__email = email
         self.__create_time = create_time
         self.__modify_time = modify_time
         self.__hash_pass = ""
-        self.__blacklist = blacklist
+        self.__blacklist = list(blacklist) if blacklist is not None else []
+        self.__blacklist_set = set(self.__blacklist)
+        self.__blacklist_version = 0
         self.__removed = False
+        self.__previous_alias = None
+        self.__observers = []
         if self.__user_id is not None:
             self.__dirty = False
         else:
@@ -36,9 +48,29 @@ class ChatUser():
     def blacklist(self):
         return self.__blacklist
 
+    @property
+    def blacklist_set(self):
+        """the blacklist as a set for O(1) membership checks. Kept in step by add/remove_alias_from_blacklist
+        """
+        return self.__blacklist_set
+
+    @property
+    def blacklist_version(self):
+        """incremented on every blacklist change, used as a cache key for filtered message views
+        """
+        return self.__blacklist_version
+
     @property
     def hash_pass(self):
         return self.__hash_pass
+
+    @property
+    def user_id(self):
+        return self.__user_id
+
+    @user_id.setter
+    def user_id(self, new_id):
+        self.__user_id = new_id
     
     @property
     def alias(self):
@@ -51,6 +83,7 @@ class ChatUser():
     @hash_pass.setter
     def hash_pass(self, new_pass):
         self.__hash_pass = new_pass
+        self.__dirty = True
         
     @property
     def email(self):
@@ -65,11 +98,17 @@ class ChatUser():
         if type(new_value) is bool:
             self.__dirty = new_value
 
+    @property
+    def previous_alias(self):
+        return self.__previous_alias
+
     @alias.setter
     def alias(self, new_alias: str):
-        if len(new_alias) > 2:
+        if len(new_alias) > 2 and new_alias != self.__alias:
+            self.__previous_alias = self.__alias
             self.__alias = new_alias
             self.__dirty = True
+            self.notify(USER_EVENT_ALIAS)
     
     @property
     def private_queue_name(self):
@@ -100,17 +139,37 @@ class ChatUser():
         if type(new_value) is bool:
             self.__removed = new_value
 
+    def add_observer(self, callback) -> None:
+        """register a callback that is called as callback(event, user) when this user changes
+        """
+        if callback not in self.__observers:
+            self.__observers.append(callback)
+
+    def remove_observer(self, callback) -> None:
+        if callback in self.__observers:
+            self.__observers.remove(callback)
+
+    def notify(self, event: str) -> None:
+        for callback in list(self.__observers):
+            callback(event, self)
+
     def add_alias_to_blacklist(self, alias) -> bool:
-        if alias not in self.blacklist:
+        if alias not in self.__blacklist_set:
             self.blacklist.append(alias)
+            self.__blacklist_set.add(alias)
+            self.__blacklist_version += 1
             self.dirty = True
+            self.notify(USER_EVENT_BLACKLIST)
             return True
         return False
 
     def remove_alias_from_blacklist(self, alias) -> bool:
-        if alias in self.blacklist:
+        if alias in self.__blacklist_set:
             self.blacklist.remove(alias)
+            self.__blacklist_set.discard(alias)
+            self.__blacklist_version += 1
             self.dirty = True
+            self.notify(USER_EVENT_BLACKLIST)
             return True
         return False
 
@@ -118,6 +177,7 @@ class ChatUser():
         return {
                 'alias': self.__alias,
                 'blacklist': self.__blacklist,
+                'hash_pass': self.__hash_pass,
                 'removed': self.__removed,
                 'create_time': self.__create_time,
                 'modify_time': self.__modify_time
@@ -133,7 +193,9 @@ class UserList():
 
     def __init__(self, list_name: str = DEFAULT_USER_LIST_NAME) -> None:
         self.__user_list = list()
-        self.__mongo_client = MongoClient(host=MONGO_HOST, port=MONGO_PORT, username=USERNAME, password=PASSWORD, authSource='cpsc313', authMechanism='SCRAM-SHA-256')
+        self.__alias_index = dict()
+        self.__subscribers = dict()
+        self.__mongo_client = MONGO_CLIENTS.get_client()
         self.__mongo_db = self.__mongo_client['cpsc313']
         self.__mongo_collection = self.__mongo_db['users']
         if self.__restore():
@@ -157,8 +219,15 @@ class UserList():
     def dirty(self):
         return self.__dirty
 
-    def register(self, new_alias: str) -> ChatUser:
-        """
+    def register(self, new_alias: str, hash_pass: str = "") -> ChatUser:
+        """ add a new user to the list and save it
+
+        Args:
+            new_alias (str): alias of the new user
+            hash_pass (str): password hash to store for the user, empty for a user that can't log in with a password
+
+        Returns:
+            ChatUser: the new user, or the existing one if the alias is already registered
         """
         LOGGER.info(f"Registering {new_alias} in {self.__name}")
         user = self.get(new_alias)
@@ -167,27 +236,85 @@ class UserList():
             return user
         if len(new_alias) > 2:
             new_user = ChatUser(new_alias)
+            new_user.hash_pass = hash_pass
             self.append(new_user)
+            new_user.notify(USER_EVENT_REGISTER)
         return new_user
     
     def deregister(self, alias_to_remove: str) -> ChatUser:
         """ set the removed flag to true for the user
-            TODO: must remove the user from all member lists
+            subscribers (the rooms) are told so they can drop the user from their member lists
         """
         if (user := self.get(alias_to_remove)) is None:
             return user
         user.removed = True
+        user.dirty = True
+        self.__unindex(user, user.alias)
+        self.persist()
+        user.notify(USER_EVENT_DEREGISTER)
         return user
 
+    def subscribe(self, callback) -> None:
+        """register a callback that is called as callback(event, user) for every change to a user in this list
+            Subscribers are kept in a dict, so subscribing and unsubscribing don't scan the others. A bound method is
+            held weakly, an object that is dropped without unsubscribing stops being called instead of being kept alive
+
+        Args:
+            callback (callable): called with one of the USER_EVENT_* names and the changed ChatUser
+        """
+        key = self.__subscriber_key(callback)
+        if key in self.__subscribers:
+            return
+        if inspect.ismethod(callback):
+            subscribers = self.__subscribers
+
+            def forget(reference, key=key):
+                if subscribers.get(key) is reference:
+                    del subscribers[key]
+            self.__subscribers[key] = weakref.WeakMethod(callback, forget)
+        else:
+            self.__subscribers[key] = lambda callback=callback: callback
+
+    def unsubscribe(self, callback) -> None:
+        self.__subscribers.pop(self.__subscriber_key(callback), None)
+
+    @staticmethod
+    def __subscriber_key(callback) -> tuple:
+        """bound methods are keyed by the identity of their object, so rooms that compare equal still get their own entry
+        """
+        if inspect.ismethod(callback):
+            return (id(callback.__self__), callback.__func__)
+        return (id(callback), None)
+
+    def __index(self, user: ChatUser) -> None:
+        """add the user to the alias index unless it is removed or another active user holds the alias
+        """
+        if not user.removed and self.get(user.alias) is None:
+            self.__alias_index[user.alias] = user
+
+    def __unindex(self, user: ChatUser, alias: str) -> None:
+        if self.__alias_index.get(alias) is user:
+            del self.__alias_index[alias]
+
+    def __on_user_changed(self, event: str, user: ChatUser) -> None:
+        if event == USER_EVENT_ALIAS:
+            self.__unindex(user, user.previous_alias)
+            self.__index(user)
+        for reference in list(self.__subscribers.values()):
+            if (callback := reference()) is not None:
+                callback(event, user)
+
     def __len__(self):
         return len(self.user_list)
 
     def get(self, target_alias: str) -> ChatUser:
-        LOGGER.info(f"Getting User {target_alias} from {self.__name}")
-        for user in self.__user_list:
-            if user.alias == target_alias and not user.removed:
+        """ find an active (not removed) user by alias using the alias index
+        """
+        if (user := self.__alias_index.get(target_alias)) is not None:
+            if not user.removed:
                 return user
-        LOGGER.warning(f"User {target_alias} not found")
+            del self.__alias_index[target_alias]
+        LOGGER.debug(f"User {target_alias} not found in {self.__name}")
         return None
 
     def get_all_users(self) -> list:
@@ -205,6 +332,8 @@ class UserList():
         """
         if new_user is not None:
             self.__user_list.append(new_user)
+            self.__index(new_user)
+            new_user.add_observer(self.__on_user_changed)
             self.__dirty = True
             self.persist()
 
@@ -222,9 +351,13 @@ class UserList():
         self.__create_time = list_data["create_time"]
         self.__modify_time = list_data["modify_time"]
         for user_dict in self.__mongo_collection.find({"list_name": {"$exists": False}}):
-            new_user = ChatUser(alias=user_dict["alias"], user_id=user_dict["_id"], create_time=user_dict["create_time"], modify_time=user_dict["modify_time"])
+            new_user = ChatUser(alias=user_dict["alias"], user_id=user_dict["_id"], blacklist=user_dict.get("blacklist", []), create_time=user_dict["create_time"], modify_time=user_dict["modify_time"])
+            new_user.removed = user_dict.get("removed", False)
+            new_user.hash_pass = user_dict.get("hash_pass", "")
             new_user.dirty = False
+            new_user.add_observer(self.__on_user_changed)
             self.user_list.append(new_user)
+            self.__index(new_user)
         LOGGER.info("Done restoring user list from Mongo")
         return True
 
@@ -252,16 +385,45 @@ class UserList():
                 self.__dirty = False
         for user in self.__user_list:
             if user.dirty:
-                if self.__mongo_collection.find_one({'alias': user.alias}) is None:
-                        user.user_id = self.__mongo_collection.insert_one(user.to_dict())
+                if user.user_id is None:
+                    user.user_id = self.__mongo_collection.insert_one(user.to_dict()).inserted_id
                 else:
                     self.__mongo_collection.replace_one({'_id': user.user_id}, user.to_dict(), upsert=True)
                 LOGGER.debug(user.to_dict())
                 user.dirty = False
         LOGGER.info("Done persisting data to Mongo")
 
-    def remove(self, user: str) -> None:
+    def remove(self, user: ChatUser) -> None:
         self.__user_list.remove(user)
+        user.remove_observer(self.__on_user_changed)
+        if self.__alias_index.get(user.alias) is user:
+            del self.__alias_index[user.alias]
+            for other_user in self.__user_list:
+                if other_user.alias == user.alias:
+                    self.__index(other_user)
 
     def to_dict(self):
         return self.__user_list
+
+
+_shared_user_lists = dict()
+_shared_user_lists_lock = threading.Lock()
+
+
+def shared_user_list(list_name: str = DEFAULT_USER_LIST_NAME) -> UserList:
+    """ get the one UserList for this process, restoring it from mongo on first use.
+        Every room and the api share this directory so a change made through one is seen by all
+
+    Args:
+        list_name (str): name of the user list
+
+    Returns:
+        UserList: process wide user directory
+    """
+    if (user_list := _shared_user_lists.get(list_name)) is not None:
+        return user_list
+    with _shared_user_lists_lock:
+        if (user_list := _shared_user_lists.get(list_name)) is None:
+            user_list = UserList(list_name)
+            _shared_user_lists[list_name] = user_list
+    return user_list
@@ -59,6 +59,26 @@ class UserTest(TestCase):
         self.assertEqual(user3.alias, USER_ALIAS + '3')
         LOGGER.info("done testing getting users")
 
+    def test_alias_index(self):
+        LOGGER.info("Testing alias index through rename and deregister")
+        user = self.__cur_users.register(USER_ALIAS + 'idx')
+        self.assertIs(self.__cur_users.get(USER_ALIAS + 'idx'), user)
+        user.alias = USER_ALIAS + 'renamed'
+        self.assertIsNone(self.__cur_users.get(USER_ALIAS + 'idx'))
+        self.assertIs(self.__cur_users.get(USER_ALIAS + 'renamed'), user)
+        self.__cur_users.deregister(USER_ALIAS + 'renamed')
+        self.assertIsNone(self.__cur_users.get(USER_ALIAS + 'renamed'))
+        LOGGER.info("done testing alias index")
+
+    def test_hash_pass_persisted(self):
+        LOGGER.info("Testing the password hash is saved with the user")
+        user = self.__cur_users.register(USER_ALIAS + 'hash', 'stored-hash')
+        self.assertEqual(user.hash_pass, 'stored-hash')
+        reloaded = UserList(DEFAULT_USER_LIST_NAME)
+        self.assertEqual(reloaded.get(USER_ALIAS + 'hash').hash_pass, 'stored-hash')
+        self.__cur_users.deregister(USER_ALIAS + 'hash')
+        LOGGER.info("done testing the password hash")
+
     def test_get_all_users(self):
         user_list = self.__cur_users.get_all_users()
         LOGGER.debug(user_list)
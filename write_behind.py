@@ -0,0 +1,177 @@
+""" By: Nathan Flack
+    Assignment: Lab 5: Message based chat MVP3
+    Class: CPSC 313- Distributed and Cloud Computing
+    Due: April 24, 2022 11:59 AM
+
+    write-behind flusher that group commits chat messages to mongo
+"""
+import queue
+import threading
+import time
+
+from constants import *
+
+LOGGER = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_FLUSH_INTERVAL = 0.5
+WRITE_BEHIND_MAX_QUEUE = 10000
+WRITE_BEHIND_PUT_TIMEOUT = 2.0
+WRITE_BEHIND_POLL_INTERVAL = 0.05
+WRITE_BEHIND_MAX_ATTEMPTS = 3
+
+
+class WriteBehindFlusher():
+    """ Background thread that takes (room, message) pairs off a bounded queue and writes them in batches.
+        A batch is written when it reaches batch_size messages or flush_interval seconds after its first message,
+        with one insert_many per room in the batch (see ChatRoom.persist_batch)
+        A message that still can't be written after max_attempts batches is handed back to its room (ChatRoom.return_unwritten),
+        which writes it with its next successful batch or persist, so flush and stop return even while mongo is down
+    """
+
+    def __init__(self, batch_size: int = WRITE_BEHIND_BATCH_SIZE, flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_queue: int = WRITE_BEHIND_MAX_QUEUE, put_timeout: float = WRITE_BEHIND_PUT_TIMEOUT,
+                 max_attempts: int = WRITE_BEHIND_MAX_ATTEMPTS) -> None:
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__put_timeout = put_timeout
+        self.__max_attempts = max_attempts
+        self.__queue = queue.Queue(maxsize=max_queue)
+        self.__flush_requested = threading.Event()
+        self.__stopping = threading.Event()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.__queue.qsize()
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self) -> None:
+        with self.__lock:
+            if self.running:
+                return
+            self.__stopping.clear()
+            self.__thread = threading.Thread(target=self.__run, name='write-behind-flusher', daemon=True)
+            self.__thread.start()
+
+    def wait_for_room(self, count: int = 1) -> bool:
+        """backpressure: wait up to put_timeout until the queue has space for count more messages.
+            Rooms call this before taking their lock, then submit without blocking
+
+        Args:
+            count (int): number of messages about to be submitted
+
+        Returns:
+            bool: False if the queue stayed too full for the whole timeout
+        """
+        maxsize = self.__queue.maxsize
+        count = min(count, maxsize)
+        if maxsize <= 0 or self.__queue.qsize() + count <= maxsize:
+            return True
+        deadline = time.monotonic() + self.__put_timeout
+        while self.__queue.qsize() + count > maxsize:
+            if time.monotonic() >= deadline:
+                LOGGER.warning(f'Write-behind queue is full ({self.queue_depth} messages), no room for {count} more')
+                return False
+            time.sleep(WRITE_BEHIND_POLL_INTERVAL)
+        return True
+
+    def submit(self, room, message, block: bool = True) -> bool:
+        """queue a message to be written. Blocks up to put_timeout when the queue is full (backpressure)
+
+        Args:
+            room (ChatRoom): room the message belongs to
+            message (ChatMessage): message to write
+            block (bool): False to fail right away on a full queue, for callers holding a lock (see wait_for_room)
+
+        Returns:
+            bool: False if the queue stayed full for the whole timeout and the message was not accepted
+        """
+        if not self.running:
+            self.start()
+        try:
+            self.__queue.put((room, message, 1), block=block, timeout=self.__put_timeout if block else None)
+            return True
+        except queue.Full:
+            LOGGER.warning(f'Write-behind queue is full ({self.queue_depth} messages), rejecting message for {room.room_name}')
+            return False
+
+    def flush(self) -> None:
+        """write everything queued so far and wait until it is in mongo
+        """
+        if not self.running:
+            return
+        self.__flush_requested.set()
+        self.__queue.join()
+        self.__flush_requested.clear()
+
+    def stop(self) -> None:
+        """flush the queue and stop the background thread. Called on shutdown
+        """
+        self.flush()
+        self.__stopping.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __next_batch(self) -> list:
+        try:
+            batch = [self.__queue.get(timeout=self.__flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.__flush_interval
+        while len(batch) < self.__batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self.__flush_requested.is_set():
+                    batch.append(self.__queue.get_nowait())
+                else:
+                    batch.append(self.__queue.get(timeout=min(remaining, WRITE_BEHIND_POLL_INTERVAL)))
+            except queue.Empty:
+                if remaining <= 0 or self.__flush_requested.is_set():
+                    break
+        return batch
+
+    def __write(self, batch: list) -> None:
+        rooms = dict()
+        for room, message, attempt in batch:
+            rooms.setdefault(id(room), (room, []))[1].append((message, attempt))
+        for room, entries in rooms.values():
+            try:
+                room.persist_batch([message for message, _ in entries])
+            except Exception as problem:
+                LOGGER.error(f'Write-behind failed for {len(entries)} messages in {room.room_name}: {problem}')
+                returned = []
+                for message, attempt in entries:
+                    if not message.dirty:
+                        continue  # written before the error, see ChatRoom.persist_batch
+                    if attempt >= self.__max_attempts:
+                        returned.append(message)
+                        continue
+                    try:
+                        self.__queue.put_nowait((room, message, attempt + 1))
+                    except queue.Full:
+                        returned.append(message)
+                if len(returned) > 0:
+                    LOGGER.error(f'Handing {len(returned)} unwritten messages back to {room.room_name}')
+                    room.return_unwritten(returned)
+                time.sleep(self.__flush_interval)
+
+    def __run(self) -> None:
+        LOGGER.info('Write-behind flusher started')
+        while not (self.__stopping.is_set() and self.__queue.empty()):
+            batch = self.__next_batch()
+            if len(batch) == 0:
+                continue
+            self.__write(batch)
+            for _ in batch:
+                self.__queue.task_done()
+        LOGGER.info('Write-behind flusher stopped')
+
+
+WRITE_BEHIND = WriteBehindFlusher()